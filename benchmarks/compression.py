@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark for the compression-backends used for backups.
+
+Compresses a generated sql-dump with every installed backend and a few
+levels and reports duration, throughput and ratio. Pass an existing dump to
+benchmark with real data.
+
+Usage: python benchmarks/compression.py [size-in-mb | dump-file]
+"""
+
+import os.path
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from lib import compression
+
+
+def create_dump(filename, size_in_mb):
+  random.seed(42)
+  words = [ 'lorem', 'ipsum', 'dolor', 'sit', 'amet', 'node', 'field', 'revision', 'cache', 'user' ]
+  with open(filename, 'w') as stream:
+    stream.write('CREATE TABLE `node` (`nid` int, `title` varchar(255), `body` longtext);\n')
+    i = 0
+    while stream.tell() < size_in_mb * 1024 * 1024:
+      body = ' '.join(random.choice(words) for _ in range(40))
+      stream.write("INSERT INTO `node` VALUES (%d,'%s %d','%s',%d);\n" % (i, random.choice(words), i, body, random.randint(0, 2 ** 31)))
+      i += 1
+
+
+def is_available(executable):
+  with open(os.devnull, 'w') as devnull:
+    return subprocess.call([ 'which', executable ], stdout=devnull, stderr=devnull) == 0
+
+
+def expand(cmd):
+  return re.sub('#!(\w+)', r'\1', cmd)
+
+
+def measure(cmd, input_filename, output_filename):
+  start_time = time.time()
+  with open(input_filename, 'rb') as stdin, open(output_filename, 'wb') as stdout:
+    subprocess.check_call(cmd, shell=True, stdin=stdin, stdout=stdout)
+  return time.time() - start_time
+
+
+if __name__ == '__main__':
+  folder = tempfile.mkdtemp()
+  if len(sys.argv) > 1 and os.path.isfile(sys.argv[1]):
+    dump_filename = sys.argv[1]
+  else:
+    dump_filename = folder + '/dump.sql'
+    create_dump(dump_filename, int(sys.argv[1]) if len(sys.argv) > 1 else 64)
+
+  size = os.path.getsize(dump_filename)
+  print 'Compressing {size:.1f} MB\n'.format(size=size / 1024.0 / 1024.0)
+  print '{label:<16} {compress:>10} {decompress:>12} {throughput:>10} {ratio:>7}'.format(
+    label='backend', compress='compress', decompress='decompress', throughput='MB/s', ratio='ratio')
+
+  for backend in sorted(compression.backends.keys()):
+    if not is_available(backend):
+      print '{label:<16} not installed'.format(label=backend)
+      continue
+
+    for level in [ 1, compression.backends[backend]['defaultLevel'], 9 ]:
+      c = compression.Compression(backend, level)
+      compressed_filename = folder + '/dump' + c.extension
+      duration = measure(expand(c.compress()), dump_filename, compressed_filename)
+      decompress_duration = measure(expand(c.decompress()), compressed_filename, os.devnull)
+
+      print '{label:<16} {compress:>9.2f}s {decompress:>11.2f}s {throughput:>10.1f} {ratio:>7.2f}'.format(
+        label='%s -%d' % (backend, level),
+        compress=duration,
+        decompress=decompress_duration,
+        throughput=size / 1024.0 / 1024.0 / duration,
+        ratio=float(size) / os.path.getsize(compressed_filename))
+      os.remove(compressed_filename)
+
+  if dump_filename.startswith(folder):
+    os.remove(dump_filename)
+  os.rmdir(folder)
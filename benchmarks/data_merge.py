@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmark for configuration.data_merge.
+
+Compares the former deepcopy-everything merge with the current
+structural-sharing merge on a large inherited configuration.
+
+Usage: python benchmarks/data_merge.py [number-of-hosts]
+"""
+
+import os.path
+import sys
+import copy
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from lib import configuration
+
+
+def deepcopy_data_merge(a, b):
+  output = {}
+  for item, value in a.iteritems():
+    if b.has_key(item):
+      if isinstance(b[item], dict):
+        output[item] = deepcopy_data_merge(value, b.pop(item))
+    else:
+      output[item] = copy.deepcopy(value)
+  for item, value in b.iteritems():
+    output[item] = copy.deepcopy(value)
+  return output
+
+
+def create_base_config(num_scripts):
+  scripts = {}
+  for i in range(num_scripts):
+    scripts['script%d' % i] = [ 'echo "running step %d of script %d"' % (n, i) for n in range(10) ]
+
+  return {
+    'rootFolder': '/var/www',
+    'needs': [ 'ssh', 'git', 'drush8', 'files' ],
+    'database': { 'name': 'db', 'user': 'user', 'pass': 'pass', 'host': 'localhost' },
+    'scripts': scripts,
+    'common': dict(('task%d' % i, { 'dev': [ 'echo dev' ], 'prod': [ 'echo prod' ] }) for i in range(num_scripts)),
+  }
+
+
+def create_hosts(num_hosts):
+  hosts = {}
+  for i in range(num_hosts):
+    hosts['host%d' % i] = {
+      'host': 'host%d.example.com' % i,
+      'user': 'user%d' % i,
+      'database': { 'name': 'db%d' % i },
+    }
+  return hosts
+
+
+def run(merge, base, hosts):
+  for name, host in hosts.iteritems():
+    merge(base, copy.copy(host))
+
+
+if __name__ == '__main__':
+  num_hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+  base = create_base_config(200)
+  hosts = create_hosts(num_hosts)
+  repeat = 3
+
+  results = []
+  for label, merge in [('deepcopy', deepcopy_data_merge), ('structural', configuration.data_merge)]:
+    duration = min(timeit.repeat(lambda: run(merge, base, hosts), number=1, repeat=repeat))
+    results.append((label, duration))
+    print '{label:<12} {hosts} hosts: {duration:8.4f}s'.format(label=label, hosts=num_hosts, duration=duration)
+
+  print 'speedup: %.1fx' % (results[0][1] / results[1][1])
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark for loading configuration data.
+
+Compares parsing a large fabfile with the pure-python yaml-loader, with the
+C-accelerated CSafeLoader and loading the parsed data from the binary cache
+used for remote and compiled configurations.
+
+Usage: python benchmarks/yaml_cache.py [number-of-hosts]
+"""
+
+import os.path
+import sys
+import tempfile
+import timeit
+import yaml
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from lib.configuration import compiled_cache
+
+
+def create_fabfile(num_hosts):
+  hosts = {}
+  for i in range(num_hosts):
+    hosts['host%d' % i] = {
+      'host': 'host%d.example.com' % i,
+      'user': 'user%d' % i,
+      'port': 22,
+      'type': 'dev',
+      'rootFolder': '/var/www/host%d/public' % i,
+      'backupFolder': '/var/www/host%d/backups' % i,
+      'branch': 'develop',
+      'database': { 'name': 'db%d' % i, 'user': 'user', 'pass': 'pass' },
+      'reset': [ 'echo "resetting host %d"' % i, 'drush cc all' ],
+    }
+  return { 'name': 'benchmark', 'needs': [ 'ssh', 'git', 'drush7', 'files' ], 'hosts': hosts }
+
+
+def load_yaml(filename, loader):
+  with open(filename, 'r') as stream:
+    return yaml.load(stream, Loader=loader)
+
+
+if __name__ == '__main__':
+  num_hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+  data = create_fabfile(num_hosts)
+
+  folder = tempfile.mkdtemp()
+  yaml_filename = folder + '/fabfile.yaml'
+  cache_filename = folder + '/fabfile.cache'
+  with open(yaml_filename, 'w') as stream:
+    yaml.dump(data, stream, default_flow_style=False)
+  compiled_cache.write_binary(cache_filename, data)
+
+  candidates = [ ('yaml.SafeLoader', lambda: load_yaml(yaml_filename, yaml.SafeLoader)) ]
+  if hasattr(yaml, 'CSafeLoader'):
+    candidates.append(('yaml.CSafeLoader', lambda: load_yaml(yaml_filename, yaml.CSafeLoader)))
+  else:
+    print 'CSafeLoader not available, install libyaml and rebuild pyyaml.'
+  candidates.append(('binary cache', lambda: compiled_cache.read_binary(cache_filename)))
+
+  for label, fn in candidates:
+    assert fn() == data
+    duration = min(timeit.repeat(fn, number=1, repeat=3))
+    print '{label:<18} {hosts} hosts: {duration:8.4f}s'.format(label=label, hosts=num_hosts, duration=duration)
+
+  os.remove(yaml_filename)
+  os.remove(cache_filename)
+  os.rmdir(folder)
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import time
+fabfile_start_time = time.time()
+
 import logging
 log = logging.getLogger('fabric.fabalicious')
 
@@ -10,7 +13,6 @@ from fabric.context_managers import settings as _settings
 from fabric.state import output
 
 import os.path
-import time
 import datetime
 import sys
 from fabric.main import list_commands
@@ -18,16 +20,23 @@ from fabric.main import list_commands
 # Import our modules.
 root_folder = os.path.dirname(os.path.realpath(os.path.dirname(__file__) + '/fabfile.py'))
 sys.path.append(root_folder)
-from lib import configuration
-from lib import blueprints
-from lib import utils
-from lib import plugins
+from lib import timings as _timings
+_timings.record('import fabric', fabfile_start_time)
+
+with _timings.measure('import fabalicious'):
+  from lib import configuration
+  from lib import blueprints
+  from lib import utils
+  from lib import plugins
+  from lib import methods
+  from lib import fanout
+  from lib import compression
+  from lib import backup_catalog
 
 configuration.fabfile_basedir = root_folder
 
-utils.setup_global_logging(root_folder)
-
-from lib import methods
+with _timings.measure('setup logging'):
+  utils.setup_global_logging(root_folder)
 
 @task
 def logLevel(level=None):
@@ -38,6 +47,16 @@ def config(configName='local'):
   c = configuration.get(configName)
   configuration.apply(c, configName)
 
+@task
+def configs(*patterns, **kwargs):
+  if not patterns:
+    log.error('Please provide at least one configuration name or pattern, e.g. configs:prod-*')
+    exit(1)
+
+  names = fanout.select(patterns, configuration.getAll()['hosts'].keys())
+  fanout.enable(names, kwargs.get('workers', 4))
+  log.info('Selected configurations: %s' % ', '.join(names))
+
 @task
 def blueprint(branch, configName=False, output=False):
   template = blueprints.getTemplate(configName)
@@ -137,6 +156,7 @@ def list():
     print '- ' + key
 
 @task
+@fanout.task
 def reset(**kwargs):
   configuration.check()
 
@@ -182,7 +202,7 @@ def getSQLDump():
   file_name = configuration.current('tmpFolder') + '/' + file_name
   methods.runTask(configuration.current(), 'backupSql', backup_file_name = file_name)
   if configuration.current('supportsZippedBackups'):
-    file_name += '.gz'
+    file_name += compression.get(configuration.current()).extension
   getFile(file_name)
   if configuration.current()['runLocally']:
     local('rm ' + file_name)
@@ -192,7 +212,7 @@ def getSQLDump():
 @task
 def getFilesDump():
   configuration.check();
-  file_name = '--'.join([configuration.current('config_name'), time.strftime("%Y%m%d-%H%M%S")]) + '.tgz'
+  file_name = '--'.join([configuration.current('config_name'), time.strftime("%Y%m%d-%H%M%S")]) + compression.get(configuration.current()).tarExtension
 
   log.info('Get files dump from %s' % configuration.current('config_name'))
 
@@ -205,6 +225,7 @@ def getFilesDump():
     run('rm ' + file_name);
 
 @task
+@fanout.task
 def backup(withFiles = True):
   configuration.check()
   log.info('backing up files and database of "%s" @ "%s"' % (configuration.getSettings('name'), configuration.current('config_name')))
@@ -229,8 +250,7 @@ def listBackups(commit = False):
 
     print "\nFound last backup for %s and commit %s:" % (configuration.current('config_name'), commit)
   else:
-    methods.runTask(configuration.current(), 'listBackups', results = results)
-    results = sorted(results, key = lambda l: (l['date'], l['time']))
+    results = get_backups()
     print "\nFound backups for "+ configuration.current('config_name') + ":"
   last_date = ''
   for result in results:
@@ -241,28 +261,34 @@ def listBackups(commit = False):
 
     print "{date} {time}  |  {commit:<30}  |  {method:<10}  |  {file}".format(**result)
 
-def get_backup_files(commit):
-  results = []
-  methods.runTask(configuration.current(), 'listBackups', results = results)
-  results = sorted(results, key = lambda l: (l['date'], l['time']))
-  # get latest hash for commit.
-  hash = False
-  for result in results:
-    if result['commit'] == commit:
-      hash = result['hash']
+def get_backups(rebuild = False):
+  # Read the backup catalog, build it by listing the backupFolder if missing.
+  config = configuration.current()
+  results = False if rebuild else backup_catalog.read(config)
+  if results is False:
+    results = []
+    methods.runTask(config, 'listBackups', results = results)
+    backup_catalog.write(config, results)
 
-  # search for hash.
-  if not hash:
-    for result in results:
-      if result['hash'] == commit:
-        hash = result['hash']
+  return sorted(results, key = lambda l: (l['date'], l['time']))
+
+def get_backup_files(commit):
+  by_hash, by_commit = backup_catalog.index(get_backups())
+  # get latest hash for commit, or search for hash.
+  hash = by_commit.get(commit, commit if commit in by_hash else False)
 
   if not hash:
     log.error('Coud not find requested backup: %s' % commit)
     listBackups()
     exit()
   else:
-    return filter(lambda r: r['hash'] == hash, results)
+    return by_hash[hash]
+
+@task
+def rebuildBackupCatalog():
+  configuration.check()
+  results = get_backups(rebuild = True)
+  log.info('Found %d backup-files in %s' % (len(results), configuration.current('backupFolder')))
 
 @task
 def getBackup(commit):
@@ -272,8 +298,20 @@ def getBackup(commit):
     remotePath = configuration.current('backupFolder') + "/" + file['file']
     localPath = './' + file['file']
 
+    # Deduplicated file-backups get packed into an archive first.
+    exported = file['method'] == 'files' and file['file'].endswith(methods.getMethod('files').manifest_extension)
+    if exported:
+      remotePath = methods.call('files', 'exportBackup', configuration.current(), file=file)
+      localPath = './' + os.path.basename(remotePath)
+
     get(remote_path=remotePath, local_path=localPath)
 
+    if exported:
+      if configuration.current()['runLocally']:
+        local('rm ' + remotePath)
+      else:
+        run('rm ' + remotePath)
+
 @task
 def restore(commit, cleanupBeforeRestore=0):
   configuration.check()
@@ -327,6 +365,7 @@ def docker(command = False, **kwargs):
   methods.call('docker', 'runCommand', configuration.current(), command = command, **kwargs)
 
 @task
+@fanout.task
 def deploy(overrideBranch=False):
   configuration.check()
   config = configuration.current()
@@ -338,6 +377,30 @@ def deploy(overrideBranch=False):
 
   methods.runTask(config, 'deploy', nextTasks=['reset'])
 
+@task
+def rollingDeploy(batchSize=1, maxFailures=0, overrideBranch=False):
+  if not fanout.config_names:
+    log.error('Please select the configurations to deploy first, e.g. fab configs:prod-* rollingDeploy')
+    exit(1)
+
+  names = fanout.config_names
+  start_time = time.time()
+  results = fanout.rolling(
+    names,
+    lambda name: deploy(overrideBranch),
+    lambda name: methods.runTask(configuration.current(), 'healthCheck'),
+    max(1, int(batchSize)),
+    int(maxFailures))
+  fanout.print_results(names, results, time.time() - start_time)
+
+  failed = [ name for name in names if name in results and not results[name]['success'] ]
+  skipped = [ name for name in names if name not in results ]
+  if skipped:
+    log.error('Rolling deploy skipped %s' % ', '.join(skipped))
+  if failed:
+    log.error('Rolling deploy failed for %s' % ', '.join(failed))
+    exit(1)
+
 
 @task
 def notify(message):
@@ -345,16 +408,16 @@ def notify(message):
   methods.runTask(configuration.current(), 'notify', message=message)
 
 @task
-def copyFilesFrom(source_config_name):
+def copyFilesFrom(source_config_name, dryRun=False):
   configuration.check()
   source_configuration = configuration.get(source_config_name)
-  methods.runTask(configuration.current(), 'copyFilesFrom', source_config=source_configuration)
+  methods.runTask(configuration.current(), 'copyFilesFrom', source_config=source_configuration, dryRun=dryRun)
 
 @task
-def copyDBFrom(source_config_name):
+def copyDBFrom(source_config_name, mode=False):
   configuration.check()
   source_configuration = configuration.get(source_config_name)
-  methods.runTask(configuration.current(), 'copyDBFrom', source_config=source_configuration, nextTasks=['reset'])
+  methods.runTask(configuration.current(), 'copyDBFrom', source_config=source_configuration, sqlCopyMode=mode, nextTasks=['reset'])
 
 
 @task
@@ -481,31 +544,103 @@ def doctor(**kwargs):
 def offline():
   configuration.offline = True
 
+@task
+def noCache():
+  configuration.use_compiled_cache = False
+
+@task
+def startupProfile():
+  _timings.enableStartupProfile()
+
+@task
+def timings(trace=False):
+  _timings.enableTracing(trace)
+
+@task
+def tunnels(command='status', configName=False):
+  from lib import tunnels as _tunnels
+
+  all_tunnels = _tunnels.get_all()
+  if configName:
+    all_tunnels = dict((f, t) for f, t in all_tunnels.iteritems() if t['configName'] == configName)
+
+  if command == 'status':
+    if not all_tunnels:
+      log.info('No persistent tunnels found.')
+      return
+
+    print "{config:<25}  {entrance:<16}  {bridge:<30}  {dest:<22}  {status:<8}  {idle:>8}".format(
+      config='configuration', entrance='entrance', bridge='bridge', dest='destination', status='status', idle='idle')
+    for filename, t in all_tunnels.iteritems():
+      print "{config:<25}  {entrance:<16}  {bridge:<30}  {dest:<22}  {status:<8}  {idle:>6.0f} s".format(
+        config=t['configName'],
+        entrance='localhost:%d' % t['localPort'],
+        bridge=t['bridge'],
+        dest=t['dest'],
+        status='running' if t['alive'] else 'stale',
+        idle=t['idle'])
+
+  elif command == 'close':
+    for filename, t in all_tunnels.iteritems():
+      _tunnels.close(filename)
+      log.info('Closed tunnel for %s on localhost:%d' % (t['configName'], t['localPort']))
+
+  else:
+    log.error('Unknown command "%s", use status or close' % command)
+    exit(1)
+
 @task
 def completions(type='fish'):
   output.status = False
   configuration.offline = True
-  if type == 'fish':
-    fish_completions()
 
+  index = configuration.get_completion_index()
+  if not index:
+    index = get_completion_index()
+    configuration.save_completion_index(index)
 
-def fish_completions():
   tasks = list_commands('', 'normal')
   tasks.pop(0)
-  for task in tasks:
-    print task.strip()
+  words = [ task.strip() for task in tasks if task.strip() ] + index['words']
+
+  if type == 'fish':
+    print "\n".join(words)
+  elif type == 'bash':
+    print bash_completion.replace('{words}', " ".join(words))
+  elif type == 'zsh':
+    print "\n".join(word.replace(':', '\\:') for word in words)
+  else:
+    log.error('Unknown completion-type "%s", use fish, bash or zsh.' % type)
+    exit(1)
+
 
+# bash splits words at colons, so complete the whole word and strip the part
+# up to its last colon from the completions.
+bash_completion = """_fab_completions() {
+  local cur="${COMP_LINE:0:$COMP_POINT}"
+  cur="${cur##* }"
+  COMPREPLY=( $(compgen -W "{words}" -- "$cur") )
+  if [[ "$cur" == *:* ]]; then
+    local prefix="${cur%"${cur##*:}"}"
+    COMPREPLY=( "${COMPREPLY[@]#"$prefix"}" )
+  fi
+}
+complete -F _fab_completions fab"""
+
+
+def get_completion_index():
+  words = []
   conf = configuration.getAll()
   for key in conf['hosts'].keys():
-    print "config:" + key
-    print "copyFrom:" + key
-    print "copyDBFrom:" + key
-    print "copyFilesFrom:" + key
-    print "installFrom:" + key
+    words.append("config:" + key)
+    words.append("copyFrom:" + key)
+    words.append("copyDBFrom:" + key)
+    words.append("copyFilesFrom:" + key)
+    words.append("installFrom:" + key)
 
   if 'scripts' in conf:
     for key in conf['scripts'].keys():
-      print "script:" + key
+      words.append("script:" + key)
 
   if 'dockerHosts' in conf:
     tasks = set()
@@ -514,7 +649,9 @@ def fish_completions():
       if docker_conf:
         tasks.update(methods.getMethod('docker').getInternalCommands() + docker_conf['tasks'].keys())
     for key in tasks:
-      print "docker:" + key
+      words.append("docker:" + key)
+
+  return { 'words': words }
 
 # Load Plugins towards the end to avoid variable name space corruption.
 for taskName, obj in plugins.getTasks(root_folder).iteritems():
@@ -0,0 +1,89 @@
+import logging
+log = logging.getLogger('fabric.fabalicious.backup_catalog')
+
+import pipes
+from StringIO import StringIO
+
+from fabric.api import local, run, put, hide, warn_only
+
+# The catalog lists every backup of a configuration, one tab-separated line
+# per backup-file, so listBackups needs only one remote command. Every
+# configuration gets its own catalog, as configurations may share a
+# backupFolder.
+catalog_name = '.fabalicious-backups'
+header = '# fabalicious backup catalog 1'
+fields = [ 'method', 'config', 'commit', 'date', 'time', 'hash', 'file' ]
+
+
+def get_filename(config):
+  return config['backupFolder'] + '/' + catalog_name + '-' + config['config_name']
+
+
+def run_command(config, cmd):
+  with hide('running', 'output', 'warnings'), warn_only():
+    if config['runLocally']:
+      return local(cmd, capture=True)
+    return run(cmd)
+
+
+def format_line(result):
+  return '\t'.join(result[key].replace('\t', ' ').replace('\n', ' ') for key in fields)
+
+
+def parse(content):
+  results = []
+  for line in content.splitlines():
+    if not line or line.startswith('#'):
+      continue
+    tokens = line.split('\t')
+    if len(tokens) != len(fields):
+      log.debug('Skipping invalid line in backup catalog: %s' % line)
+      continue
+    results.append(dict(zip(fields, tokens)))
+  return results
+
+
+def read(config):
+  """Returns all backups listed in the catalog, False if there is no catalog."""
+  result = run_command(config, 'cat ' + pipes.quote(get_filename(config)))
+  if result.return_code != 0 or not result.stdout.startswith(header):
+    return False
+  return [ entry for entry in parse(result.stdout) if entry['config'] == config['config_name'] ]
+
+
+def write(config, results):
+  # Without a backupFolder there is nothing to list, keep it that way.
+  if run_command(config, 'test -d ' + pipes.quote(config['backupFolder'])).return_code != 0:
+    return
+
+  filename = get_filename(config)
+  content = '\n'.join([ header ] + [ format_line(result) for result in results ]) + '\n'
+  if config['runLocally']:
+    with open(filename + '.tmp', 'w') as stream:
+      stream.write(content)
+  else:
+    with hide('running'):
+      put(StringIO(content), filename + '.tmp')
+  run_command(config, 'mv {f}.tmp {f}'.format(f=pipes.quote(filename)))
+
+
+def add(config, result):
+  """Appends a new backup to an existing catalog.
+
+  Without a catalog nothing gets written, the next listBackups builds it
+  from all files in the backupFolder.
+  """
+  filename = pipes.quote(get_filename(config))
+  run_command(config, 'if [ -f {f} ]; then printf "%s\\n" {line} >> {f}; fi'.format(
+    f=filename,
+    line=pipes.quote(format_line(result))))
+
+
+def index(results):
+  """Returns the backups keyed by hash and by commit, the latest wins."""
+  by_hash = {}
+  by_commit = {}
+  for result in sorted(results, key = lambda r: (r['date'], r['time'])):
+    by_hash.setdefault(result['hash'], []).append(result)
+    by_commit[result['commit']] = result['hash']
+  return by_hash, by_commit
@@ -0,0 +1,97 @@
+import logging
+log = logging.getLogger('fabric.fabalicious.compression')
+
+# Compression backends for database- and files-backups. The commands use the
+# executables of the host, so `#!zstd` can point to a custom binary.
+backends = {
+  'gzip': {
+    'extension': '.gz',
+    'tarExtension': '.tgz',
+    'compress': '#!gzip -c -{level}',
+    'decompress': '#!gzip -dc',
+    'defaultLevel': 6,
+  },
+  'pigz': {
+    'extension': '.gz',
+    'tarExtension': '.tgz',
+    'compress': '#!pigz -c -{level}{threads}',
+    'decompress': '#!pigz -dc{threads}',
+    'threads': ' -p {threads}',
+    'defaultLevel': 6,
+  },
+  'zstd': {
+    'extension': '.zst',
+    'tarExtension': '.tar.zst',
+    'compress': '#!zstd -c -q -{level} -T{threads}',
+    'decompress': '#!zstd -dc -q',
+    'defaultLevel': 3,
+  },
+}
+
+executables = [ 'gzip', 'pigz', 'zstd' ]
+
+
+class Compression(object):
+
+  def __init__(self, backend, level = False, threads = 0):
+    if backend not in backends:
+      log.error('Unknown compression backend "%s", use one of %s' % (backend, ', '.join(sorted(backends.keys()))))
+      exit(1)
+
+    self.backend = backend
+    self.settings = backends[backend]
+    self.level = int(level) if level else self.settings['defaultLevel']
+    self.threads = int(threads)
+    self.extension = self.settings['extension']
+    self.tarExtension = self.settings['tarExtension']
+
+  def getThreads(self):
+    # 0 lets zstd and pigz use all cores.
+    if 'threads' in self.settings:
+      return self.settings['threads'].format(threads=self.threads) if self.threads > 0 else ''
+    return self.threads
+
+  def compress(self):
+    return self.settings['compress'].format(level=self.level, threads=self.getThreads())
+
+  def decompress(self):
+    return self.settings['decompress'].format(threads=self.getThreads())
+
+
+def get(config):
+  """Returns the compression configured for a host, see the setting `compression`."""
+  from lib import configuration
+
+  settings = { 'backend': 'gzip', 'level': False, 'threads': 0 }
+  settings.update(configuration.getSettings('compression', {}) or {})
+  settings.update(config.get('compression', {}) or {})
+
+  return Compression(settings['backend'], settings['level'], settings['threads'])
+
+
+def for_file(config, filename):
+  """Returns the compression able to decompress filename, False if it is not compressed."""
+  current = get(config)
+  if filename.endswith(current.extension) or filename.endswith(current.tarExtension):
+    return current
+
+  for backend, settings in sorted(backends.items()):
+    if filename.endswith(settings['extension']) or filename.endswith(settings['tarExtension']):
+      return Compression(backend)
+
+  return False
+
+
+def get_extensions():
+  return sorted(set(b['extension'] for b in backends.values()))
+
+
+def get_tar_extensions():
+  return sorted(set(b['tarExtension'] for b in backends.values()))
+
+
+def strip_extension(filename, extensions):
+  for extension in sorted(extensions, key=len, reverse=True):
+    if filename.endswith(extension):
+      return filename[0:-len(extension)]
+  return filename
@@ -4,13 +4,17 @@ log = logging.getLogger('fabric.fabalicious.configuration')
 from fabric.api import *
 from fabric.state import output, env
 import os.path
-import urllib2
-import yaml
 import copy
 import glob
 import hashlib
 import sys
-from lib.utils import validate_dict
+from lib.utils import validate_dict, load_yaml
+from lib import utils
+from lib import timings
+import compiled_cache
+import remote
+from lazy_dict import LazyConfigDict
+from inheritance import InheritanceResolver
 
 fabalicious_version = '2.4.1'
 
@@ -24,6 +28,16 @@ env.use_shell = False
 fabfile_basedir = False
 offline = False
 cache = {}
+remote_raw_cache = {}
+remote_cache_ttl = 0
+
+use_compiled_cache = True
+compiled_data = False
+compiled_file_name = False
+dependencies = compiled_cache.Dependencies()
+dynamic_hosts = set()
+resolvers = []
+external_resolver = False
 
 globalMethodSettings = {}
 
@@ -31,10 +45,12 @@ def load_all_yamls_from_dir(path):
   result = {}
   files = glob.glob(path+'/*.yaml') + glob.glob(path+'/*.yml')
 
+  dependencies.addDir(path)
+
   for file in files:
     try:
       stream = open(file, 'r')
-      data = yaml.load(stream)
+      data = load_yaml(stream)
       key = os.path.basename(file)
       key = os.path.splitext(key)[0]
       result[key] = data
@@ -45,12 +61,24 @@ def load_all_yamls_from_dir(path):
   return result
 
 
+def lazy_load_all_yamls_from_dir(path):
+  """Like load_all_yamls_from_dir, but parses the files on first access."""
+  files = glob.glob(path+'/*.yaml') + glob.glob(path+'/*.yml')
+  dependencies.addDir(path)
+
+  return LazyConfigDict.fromFiles(files)
+
 
 def load_configuration(input_file):
   log.debug("Reading configuration from %s" % input_file)
 
+  dependencies.addFile(input_file)
   stream = open(input_file, 'r')
-  data = yaml.load(stream)
+  data = load_yaml(stream)
+
+  global remote_cache_ttl
+  remote_cache_ttl = data.get('remoteConfigCacheTTL', 0)
+  prefetch_remote_configurations(data)
 
   if 'hosts' not in data:
     data['hosts'] = {}
@@ -59,8 +87,8 @@ def load_configuration(input_file):
 
   if (os.path.basename(input_file) == 'index.yaml'):
     path = os.path.dirname(input_file)
-    hosts = load_all_yamls_from_dir(path + "/hosts")
-    dockerHosts = load_all_yamls_from_dir(path + "/dockerHosts")
+    hosts = lazy_load_all_yamls_from_dir(path + "/hosts")
+    dockerHosts = lazy_load_all_yamls_from_dir(path + "/dockerHosts")
     if hosts:
       data['hosts'] = hosts
     if dockerHosts:
@@ -71,24 +99,41 @@ def load_configuration(input_file):
     check_fabalicious_version(data['requires'], 'file ' + input_file)
 
   override_filename = find_configfiles(['fabfile.local.yaml'], 3)
+  dependencies.override = override_filename
+  if override_filename:
+    dependencies.addFile(override_filename)
+
   if override_filename and ('disableLocalOverrides' not in data or data['disableLocalOverrides'] == 0):
     log.warning('Using overrides from %s' % override_filename)
-    override_data = yaml.load(open(override_filename, 'r'))
+    override_data = load_yaml(open(override_filename, 'r'))
     data = data_merge(data, override_data)
 
   return data
 
 
-def get_all_configurations():
+def find_configuration_file():
   global fabfile_basedir
-  # Find our configuration-file:
-  candidates = ['fabfile.yaml', '.fabfile.yaml', 'fabalicious/index.yaml', '.fabalicious/index.yaml', 'fabfile.yaml.inc']
+  global compiled_file_name
+
+  if not compiled_file_name:
+    # Find our configuration-file:
+    candidates = ['fabfile.yaml', '.fabfile.yaml', 'fabalicious/index.yaml', '.fabalicious/index.yaml', 'fabfile.yaml.inc']
+
+    compiled_file_name = find_configfiles(candidates, 3)
+    if compiled_file_name:
+      fabfile_basedir = os.path.dirname(compiled_file_name)
 
-  config_file_name = find_configfiles(candidates, 3)
+  return compiled_file_name
+
+
+def get_all_configurations():
+  if compiled_data:
+    return compiled_data['data']
+
+  config_file_name = find_configuration_file()
   if (config_file_name):
-    fabfile_basedir = os.path.dirname(config_file_name)
     try:
-      return load_configuration(config_file_name)
+      return load_compiled_configuration(config_file_name)['data']
     except IOError:
       print "could not read from %s " % (config_file_name)
   else:
@@ -96,6 +141,107 @@ def get_all_configurations():
 
   exit(1)
 
+def load_compiled_configuration(config_file_name):
+  """Load the configuration from the compiled cache, if all contributing
+  files are unchanged, otherwise parse and resolve it and update the cache.
+  """
+  global compiled_data
+  global compiled_file_name
+  global dependencies
+  global remote_cache_ttl
+
+  compiled_file_name = config_file_name
+
+  if use_compiled_cache:
+    data = compiled_cache.load(config_file_name, fabalicious_version)
+    if data:
+      remote_cache_ttl = data['remoteConfigCacheTTL']
+      override_filename = find_configfiles(['fabfile.local.yaml'], 3)
+      if compiled_cache.is_valid(data['dependencies'], override_filename, get_remote_config_hashes):
+        log.debug('Using compiled configuration for %s' % config_file_name)
+        dependencies = data['dependencies']
+        compiled_data = data
+        return compiled_data
+
+  dependencies = compiled_cache.Dependencies()
+  compiled_data = {
+    'data': load_configuration(config_file_name),
+    'hosts': {},
+    'dependencies': dependencies,
+    'remoteConfigCacheTTL': remote_cache_ttl
+  }
+  save_compiled_configuration()
+
+  return compiled_data
+
+
+def save_compiled_configuration():
+  if use_compiled_cache and compiled_data:
+    compiled_cache.save(compiled_file_name, compiled_data, fabalicious_version)
+
+
+def get_completion_index():
+  """Get the cached completion-index, or False if it is outdated."""
+  config_file_name = find_configuration_file()
+  if not use_compiled_cache or not config_file_name:
+    return False
+
+  index = compiled_cache.read_binary(compiled_cache.get_filename(config_file_name, '.completions'))
+  if not index or index['version'] != fabalicious_version:
+    return False
+
+  override_filename = find_configfiles(['fabfile.local.yaml'], 3)
+  if not compiled_cache.is_valid(index['dependencies'], override_filename, get_remote_config_hashes):
+    return False
+
+  return index
+
+
+def save_completion_index(index):
+  config_file_name = find_configuration_file()
+  if not use_compiled_cache or not config_file_name:
+    return
+
+  index['version'] = fabalicious_version
+  index['dependencies'] = dependencies
+  compiled_cache.write_binary(compiled_cache.get_filename(config_file_name, '.completions'), index)
+
+
+def get_remote_config_hash(url):
+  if offline:
+    return None
+
+  content = get_remote_content(url)
+  if content is False:
+    return None
+
+  return hashlib.md5(content).hexdigest()
+
+
+def get_remote_config_hashes(urls):
+  """Revalidate all urls concurrently, returns their hashes keyed by url."""
+  missing = [ url for url in urls if url not in remote_raw_cache ]
+  if missing and not offline:
+    remote_raw_cache.update(remote.fetch_all(missing, remote_cache_ttl))
+
+  return dict((url, get_remote_config_hash(url)) for url in urls)
+
+
+def resolve_host_configuration(name, hosts):
+  cacheable = compiled_data and name not in dynamic_hosts and name in compiled_data['data']['hosts']
+  if cacheable and name in compiled_data['hosts']:
+    return copy.deepcopy(compiled_data['hosts'][name])
+
+  prefetch_remote_configurations(hosts[name])
+  host_config = copy.deepcopy(get_resolver(hosts).resolve(name))
+
+  if cacheable:
+    compiled_data['hosts'][name] = copy.deepcopy(host_config)
+    save_compiled_configuration()
+
+  return host_config
+
+
 def find_configfiles(candidates, max_levels):
   global fabfile_basedir
 
@@ -116,60 +262,55 @@ def find_configfiles(candidates, max_levels):
 
 
 def data_merge(a, b):
-  output = {}
-  for item, value in a.iteritems():
-    if b.has_key(item):
-      if isinstance(b[item], dict):
-        output[item] = data_merge(value, b.pop(item))
-    else:
-      output[item] = copy.deepcopy(value)
+  """Merge b into a, and return the result.
+
+  Neither a nor b get modified, unchanged subtrees are shared with the
+  result instead of being copied. Copy the result before modifying nested
+  values.
+  """
+  output = a.copy() if isinstance(a, LazyConfigDict) else dict(a)
   for item, value in b.iteritems():
-    output[item] = copy.deepcopy(value)
+    if isinstance(value, dict) and item in a and isinstance(a[item], dict):
+      output[item] = data_merge(a[item], value)
+    else:
+      output[item] = value
   return output
 
 
-def resolve_inheritance(config, all_configs):
-  if not config or 'inheritsFrom' not in config:
-    return config
-
-  inherits_from = config['inheritsFrom']
-  config.pop('inheritsFrom', None)
+def get_external_configuration(inherits_from):
+  if inherits_from[0:7] == 'http://' or inherits_from[0:8] == 'https://':
+    return get_configuration_via_http(inherits_from)
 
-  if not isinstance(inherits_from, basestring):
-    for item in reversed(inherits_from):
-      config['inheritsFrom'] = item
-      config = resolve_inheritance_impl(config, all_configs)
+  return get_configuration_via_file(inherits_from)
 
-    return config
 
-  else:
-    config['inheritsFrom'] = inherits_from
-    return resolve_inheritance_impl(config, all_configs)
+def get_resolver(all_configs):
+  """Get the memoizing inheritance-resolver for a set of configurations."""
+  global external_resolver
 
+  if not all_configs:
+    if not external_resolver:
+      external_resolver = InheritanceResolver({}, get_external_configuration, data_merge)
+    return external_resolver
 
-def resolve_inheritance_impl(config, all_configs):
-  if 'inheritsFrom' not in config:
-    return config
+  for configs, resolver in resolvers:
+    if configs is all_configs:
+      return resolver
 
-  inherits_from = config['inheritsFrom']
-  base_config = False
+  resolver = InheritanceResolver(all_configs, get_external_configuration, data_merge)
+  resolvers.append((all_configs, resolver))
 
-  if inherits_from[0:7] == 'http://' or inherits_from[0:8] == 'https://':
-    base_config = get_configuration_via_http(inherits_from)
+  return resolver
 
-  elif inherits_from[0:1] == '.' or inherits_from[0:1] == '/':
-    base_config = get_configuration_via_file(inherits_from)
 
-  elif inherits_from in all_configs:
-    base_config = copy.deepcopy(all_configs[inherits_from])
+def invalidate_resolvers():
+  for configs, resolver in resolvers:
+    resolver.invalidate()
 
-  if base_config and 'inheritsFrom' in base_config:
-    base_config = resolve_inheritance(base_config, all_configs)
 
-  if base_config:
-    config = data_merge(base_config, config)
+def resolve_inheritance(config, all_configs):
+  return get_resolver(all_configs).resolveConfig(config)
 
-  return config
 
 def versiontuple(v):
   return tuple(map(int, (v.split("."))))
@@ -232,14 +373,13 @@ def get_configuration(name):
   config = getAll()
 
   if name in config['hosts']:
-    host_config = copy.deepcopy(config['hosts'][name])
-    host_config = resolve_inheritance(host_config, config['hosts'])
+    host_config = resolve_host_configuration(name, config['hosts'])
 
     if 'requires' in host_config:
       check_fabalicious_version(host_config['requires'], 'host-configuration ' + name)
 
     if 'needs' not in host_config:
-      host_config['needs'] = config['needs']
+      host_config['needs'] = list(config['needs'])
 
     if 'runLocally' not in host_config:
       host_config['runLocally'] = False
@@ -268,7 +408,7 @@ def get_configuration(name):
 
     for key in defaults:
       if key not in host_config:
-        host_config[key] = defaults[key]
+        host_config[key] = copy.deepcopy(defaults[key])
 
     apply_config_by_methods(host_config, config)
 
@@ -310,44 +450,48 @@ def get_configuration_via_file(config_file_name):
     return False
 
   data = False
+  dependencies.addFile(found)
   # print "Reading configuration from %s" % found
   try:
     stream = open(found, 'r')
-    data = yaml.load(stream)
+    data = load_yaml(stream)
   except IOError:
     log.error("could not read configuration from %s" % found)
 
   return data
 
 def remote_config_cache_get_filename(config_file_name, as_yaml):
-  m = hashlib.md5()
-  m.update(config_file_name);
-  filename = os.path.expanduser("~") + "/.fabalicious/" + m.hexdigest()
-  filename += '.yaml' if as_yaml else '.data'
+  return remote.get_cache_filename(config_file_name, '.cache' if as_yaml else '.data')
 
-  if not os.path.exists(os.path.dirname(filename)):
-    os.makedirs(os.path.dirname(filename))
-
-  return filename
-
-def remote_config_cache_save(config_file_name, data, as_yaml):
+def remote_config_cache_save(config_file_name, data, as_yaml, content_hash = False):
   filename = remote_config_cache_get_filename(config_file_name, as_yaml)
-  stream = open(filename, 'w')
   if as_yaml:
-    yaml.dump(data, stream, default_flow_style=False)
+    compiled_cache.write_binary(filename, { 'hash': content_hash, 'data': data })
   else:
-    stream.write(data)
+    with open(filename, 'w') as stream:
+      stream.write(data)
 
-def remote_config_cache_load(config_file_name, as_yaml):
+def remote_config_cache_load(config_file_name, as_yaml, content_hash = False):
+  """Load cached remote data, if content_hash is set, the cached data needs
+  to be parsed from the same content."""
   try:
     filename = remote_config_cache_get_filename(config_file_name, as_yaml)
-    stream = open(filename, 'r')
-    if as_yaml:
-      data = yaml.load(stream)
-    else:
-      data = stream.read()
-
-    return data
+    if not as_yaml:
+      with open(filename, 'r') as stream:
+        return stream.read()
+
+    cached = compiled_cache.read_binary(filename)
+    if cached is None:
+      if content_hash:
+        return False
+      # Fall back to caches written by older versions.
+      with open(remote.get_cache_filename(config_file_name, '.yaml'), 'r') as stream:
+        return load_yaml(stream)
+
+    if content_hash and cached['hash'] != content_hash:
+      return False
+
+    return cached['data']
   except:
     return False
 
@@ -363,12 +507,23 @@ def get_configuration_via_http_impl(config_file_name, as_yaml = True):
       raise Exception('offline')
 
     # print "Reading configuration from %s" % config_file_name
-    response = urllib2.urlopen(config_file_name)
-    html = response.read()
-    data = yaml.load(html) if as_yaml else html
-    remote_config_cache_save(config_file_name, data, as_yaml)
+    html = get_remote_content(config_file_name)
+    if html is False:
+      raise Exception('Could not read %s' % config_file_name)
+
+    dependencies.addUrl(config_file_name, html)
+    if not as_yaml:
+      return html
+
+    # Reuse the parsed data if the content did not change.
+    content_hash = hashlib.md5(html).hexdigest()
+    data = remote_config_cache_load(config_file_name, as_yaml, content_hash)
+    if data is False:
+      data = load_yaml(html)
+      remote_config_cache_save(config_file_name, data, as_yaml, content_hash)
+
     return data
-  except (Exception, urllib2.URLError, urllib2.HTTPError) as err:
+  except Exception as err:
     data = remote_config_cache_load(config_file_name, as_yaml)
     if data:
       if offline:
@@ -383,9 +538,38 @@ def get_configuration_via_http_impl(config_file_name, as_yaml = True):
   return False
 
 
+def get_remote_content(url):
+  if url not in remote_raw_cache:
+    remote_raw_cache[url] = remote.fetch(url, remote_cache_ttl)
+
+  return remote_raw_cache[url]
+
+
+def prefetch_remote_configurations(data):
+  """Fetch all remote configurations referenced by data concurrently.
+
+  Every fetched configuration is scanned for further urls, which get
+  fetched in the next round.
+  """
+  urls = [ url for url in remote.collect_urls(data) if url not in cache ]
+  while urls and not offline:
+    missing = [ url for url in urls if url not in remote_raw_cache ]
+    if missing:
+      log.debug('Fetching %s' % ', '.join(missing))
+      remote_raw_cache.update(remote.fetch_all(missing, remote_cache_ttl))
+
+    next_urls = set()
+    for url in urls:
+      remote.collect_urls(get_configuration_via_http(url), next_urls)
+    urls = [ url for url in next_urls if url not in cache ]
+
+
 def apply(config, name):
+  from lib import methods
 
   env.config = config
+  methods.getDispatchTable(config)
+  utils.ssh_multiplexing = config.get('sshMultiplexing', False)
 
   global current_config
   current_config = name
@@ -446,9 +630,15 @@ def getAll():
 
   if not root_data:
 
-    root_data = get_all_configurations()
+    with timings.measure('load configuration'):
+      root_data = get_all_configurations()
     root_data = data_merge(globalMethodSettings, root_data)
 
+    # The host-lists get modified later on, don't touch the compiled ones.
+    for key in ['hosts', 'dockerHosts']:
+      if key in root_data:
+        root_data[key] = root_data[key].copy()
+
     if not 'common' in root_data:
       root_data['common'] = { }
 
@@ -494,6 +684,9 @@ def expandBlueprints(data):
     for variant in blueprint['variants']:
       c = blueprints.apply(variant, template)
       data['hosts'][c['configName']] = c
+      dynamic_hosts.add(c['configName'])
+
+  invalidate_resolvers()
 
 
 def getSettings(key = False, defaultValue = False):
@@ -521,8 +714,7 @@ def getDockerConfig(docker_config_name, runLocally = False, printErrors=True):
   if not dockerHosts or docker_config_name not in dockerHosts:
     return False
 
-  docker_config = copy.deepcopy(dockerHosts[docker_config_name])
-  docker_config = resolve_inheritance(docker_config, dockerHosts)
+  docker_config = copy.deepcopy(get_resolver(dockerHosts).resolve(docker_config_name))
 
   if 'runLocally' in docker_config and docker_config['runLocally'] or runLocally:
     keys = ['rootFolder', 'tasks']
@@ -544,6 +736,8 @@ def getDockerConfig(docker_config_name, runLocally = False, printErrors=True):
 def add(config_name, config):
   settings = getAll()
   settings['hosts'][config_name] = config
+  dynamic_hosts.add(config_name)
+  invalidate_resolvers()
 
 
 def addGlobalSettings(data):
@@ -551,6 +745,12 @@ def addGlobalSettings(data):
   global root_data
 
   if root_data:
-    root_data = data_merge(data, root_data)
+    # Methods get loaded on demand, so merge into the existing settings
+    # instead of replacing them, as callers might hold a reference.
+    for key, value in data.iteritems():
+      if key not in root_data:
+        root_data[key] = value
+      elif isinstance(value, dict) and isinstance(root_data[key], dict):
+        root_data[key] = data_merge(value, root_data[key])
   else:
     globalMethodSettings = data_merge(globalMethodSettings, data)
@@ -0,0 +1,124 @@
+import logging
+log = logging.getLogger('fabric.fabalicious.configuration')
+
+import os
+import glob
+import hashlib
+import tempfile
+import cPickle as pickle
+
+CACHE_FORMAT = 3
+
+
+class Dependencies(object):
+  """Collects every file, folder and url contributing to a configuration."""
+
+  def __init__(self):
+    self.files = {}
+    self.dirs = {}
+    self.urls = {}
+    self.override = False
+
+  def addFile(self, filename):
+    filename = os.path.abspath(filename)
+    self.files[filename] = fingerprint_file(filename)
+
+  def addDir(self, path):
+    path = os.path.abspath(path)
+    self.dirs[path] = fingerprint_dir(path)
+
+  def addUrl(self, url, content):
+    self.urls[url] = hashlib.md5(content).hexdigest() if content else False
+
+
+def fingerprint_file(filename):
+  try:
+    st = os.stat(filename)
+    return (st.st_mtime, st.st_size)
+  except OSError:
+    return False
+
+
+def fingerprint_dir(path):
+  files = sorted(glob.glob(path + '/*.yaml') + glob.glob(path + '/*.yml'))
+  return [ (f, fingerprint_file(f)) for f in files ]
+
+
+def get_filename(config_file_name, extension = '.cache'):
+  m = hashlib.md5()
+  m.update(os.path.abspath(config_file_name))
+  return os.path.expanduser("~") + "/.fabalicious/compiled/" + m.hexdigest() + extension
+
+
+def read_binary(filename):
+  """Read data written by write_binary, returns None if not available."""
+  if not os.path.exists(filename):
+    return None
+
+  try:
+    with open(filename, 'rb') as stream:
+      payload = pickle.load(stream)
+  except Exception as e:
+    log.debug('Could not read cached data from %s: %s' % (filename, e))
+    return None
+
+  if not isinstance(payload, dict) or payload.get('format') != CACHE_FORMAT:
+    return None
+
+  return payload['data']
+
+
+def write_binary(filename, data):
+  folder = os.path.dirname(filename)
+  try:
+    if not os.path.exists(folder):
+      os.makedirs(folder)
+
+    # Write to a temporary file first, so concurrent runs never see a partial cache.
+    fd, tmp_filename = tempfile.mkstemp(dir=folder)
+    with os.fdopen(fd, 'wb') as stream:
+      pickle.dump({ 'format': CACHE_FORMAT, 'data': data }, stream, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_filename, filename)
+  except (IOError, OSError, pickle.PicklingError) as e:
+    log.debug('Could not write cached data to %s: %s' % (filename, e))
+
+
+def load(config_file_name, version):
+  data = read_binary(get_filename(config_file_name))
+  if not isinstance(data, dict) or data.get('version') != version:
+    return False
+
+  return data
+
+
+def save(config_file_name, data, version):
+  data['version'] = version
+  write_binary(get_filename(config_file_name), data)
+
+
+def is_valid(dependencies, override_filename, get_url_hashes):
+  """Check if all dependencies recorded in a cache are still unchanged.
+
+  get_url_hashes is called once with all remote dependencies and should
+  return a dict with the md5 of the current content per url, or None if it
+  can't be determined.
+  """
+  if dependencies.override != override_filename:
+    return False
+
+  for filename, fingerprint in dependencies.files.iteritems():
+    if fingerprint_file(filename) != fingerprint:
+      return False
+
+  for path, fingerprint in dependencies.dirs.iteritems():
+    if fingerprint_dir(path) != fingerprint:
+      return False
+
+  if dependencies.urls:
+    current_hashes = get_url_hashes(dependencies.urls.keys())
+    for url, content_hash in dependencies.urls.iteritems():
+      current_hash = current_hashes.get(url)
+      if current_hash is not None and current_hash != content_hash:
+        return False
+
+  return True
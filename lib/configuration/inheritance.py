@@ -0,0 +1,74 @@
+import logging
+log = logging.getLogger('fabric.fabalicious.configuration')
+
+
+class InheritanceResolver(object):
+  """Resolves `inheritsFrom` for a keyed set of configurations.
+
+  Every configuration (and every external file or url) is resolved exactly
+  once, the results are memoized. Resolved configurations are shared between
+  callers, so they must not be modified -- copy them first.
+  """
+
+  def __init__(self, configs, load_external, merge):
+    self.configs = configs
+    self.load_external = load_external
+    self.merge = merge
+    self.resolved = {}
+    self.resolving = []
+
+  def invalidate(self):
+    self.resolved = {}
+
+  @staticmethod
+  def isExternal(reference):
+    return reference[0:7] == 'http://' or reference[0:8] == 'https://' or reference[0:1] == '.' or reference[0:1] == '/'
+
+  def resolve(self, reference):
+    if reference in self.resolved:
+      return self.resolved[reference]
+
+    if reference in self.resolving:
+      cycle = self.resolving[self.resolving.index(reference):] + [ reference ]
+      log.error('Found circular inheritance: %s' % ' -> '.join(cycle))
+      exit(1)
+
+    if self.isExternal(reference):
+      config = self.load_external(reference)
+    elif reference in self.configs:
+      config = self.configs[reference]
+    else:
+      config = False
+
+    self.resolving.append(reference)
+    result = self.resolveConfig(config)
+    self.resolving.pop()
+
+    # Missing configurations might get added later, don't remember them.
+    if config is not False:
+      self.resolved[reference] = result
+
+    return result
+
+  def resolveConfig(self, config):
+    if not config or 'inheritsFrom' not in config:
+      return config
+
+    inherits_from = config['inheritsFrom']
+    if isinstance(inherits_from, basestring):
+      items = [ inherits_from ]
+    else:
+      items = inherits_from
+
+    result = config
+    for item in reversed(items):
+      base_config = self.resolve(item)
+      if base_config:
+        result = self.merge(base_config, result)
+
+    if not isinstance(inherits_from, basestring) and len(items) > 0:
+      # Be backwards compatible, a list of parents got reduced to its first item.
+      result = dict(result) if result is config else result
+      result['inheritsFrom'] = items[0]
+
+    return result
@@ -0,0 +1,131 @@
+import logging
+log = logging.getLogger('fabric.fabalicious.configuration')
+
+import copy
+import os.path
+from lib.utils import load_yaml
+
+
+class LazyConfigDict(dict):
+  """A dict of configurations which parses its yaml-files on first access.
+
+  The keys are known upfront (usually from a directory listing), so listing
+  and checking for existance is cheap, the values get parsed on demand.
+  """
+
+  def __init__(self, pending = None):
+    dict.__init__(self)
+    self.pending = pending if pending else {}
+
+  @staticmethod
+  def fromFiles(files):
+    pending = {}
+    for file in files:
+      key = os.path.splitext(os.path.basename(file))[0]
+      pending[key] = file
+    return LazyConfigDict(pending)
+
+  def load(self, key):
+    file = self.pending[key]
+    try:
+      log.debug('Reading configuration from %s' % file)
+      with open(file, 'r') as stream:
+        dict.__setitem__(self, key, load_yaml(stream))
+    except IOError as e:
+      log.error('Could not read from %s' % file)
+      log.error(e)
+      return
+
+    # Keep the entry pending until it got read successfully.
+    del self.pending[key]
+
+  def loadAll(self):
+    for key in self.pending.keys():
+      self.load(key)
+
+  def __getitem__(self, key):
+    if key in self.pending:
+      self.load(key)
+    return dict.__getitem__(self, key)
+
+  def __setitem__(self, key, value):
+    self.pending.pop(key, None)
+    dict.__setitem__(self, key, value)
+
+  def __delitem__(self, key):
+    if key in self.pending:
+      del self.pending[key]
+    else:
+      dict.__delitem__(self, key)
+
+  def __contains__(self, key):
+    return key in self.pending or dict.__contains__(self, key)
+
+  def has_key(self, key):
+    return self.__contains__(key)
+
+  def get(self, key, default = None):
+    return self[key] if key in self else default
+
+  def pop(self, key, *args):
+    if key in self.pending:
+      self.load(key)
+    return dict.pop(self, key, *args)
+
+  def update(self, *args, **kwargs):
+    for key, value in dict(*args, **kwargs).iteritems():
+      self[key] = value
+
+  def __len__(self):
+    return dict.__len__(self) + len(self.pending)
+
+  def iterkeys(self):
+    for key in dict.iterkeys(self):
+      yield key
+    for key in self.pending.keys():
+      yield key
+
+  def __iter__(self):
+    return self.iterkeys()
+
+  def keys(self):
+    return list(self.iterkeys())
+
+  def iteritems(self):
+    self.loadAll()
+    return dict.iteritems(self)
+
+  def items(self):
+    self.loadAll()
+    return dict.items(self)
+
+  def itervalues(self):
+    self.loadAll()
+    return dict.itervalues(self)
+
+  def values(self):
+    self.loadAll()
+    return dict.values(self)
+
+  def __eq__(self, other):
+    self.loadAll()
+    return dict.__eq__(self, other)
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def copy(self):
+    result = LazyConfigDict(dict(self.pending))
+    dict.update(result, dict.iteritems(self))
+    return result
+
+  def __deepcopy__(self, memo):
+    result = LazyConfigDict(dict(self.pending))
+    memo[id(self)] = result
+    for key, value in dict.iteritems(self):
+      dict.__setitem__(result, key, copy.deepcopy(value, memo))
+    return result
+
+  def __reduce__(self):
+    # Pickle only the already loaded entries, pending entries stay pending.
+    return (LazyConfigDict, (self.pending, ), None, None, dict.iteritems(self))
@@ -0,0 +1,156 @@
+import logging
+log = logging.getLogger('fabric.fabalicious.configuration')
+
+import os
+import time
+import json
+import hashlib
+import threading
+import Queue
+import urllib2
+
+max_workers = 8
+
+
+def get_cache_filename(url, extension):
+  m = hashlib.md5()
+  m.update(url)
+  filename = os.path.expanduser("~") + "/.fabalicious/" + m.hexdigest() + extension
+
+  if not os.path.exists(os.path.dirname(filename)):
+    os.makedirs(os.path.dirname(filename))
+
+  return filename
+
+
+def load_meta(url):
+  try:
+    with open(get_cache_filename(url, '.meta'), 'r') as stream:
+      return json.load(stream)
+  except (IOError, ValueError):
+    return {}
+
+
+def save_meta(url, meta):
+  with open(get_cache_filename(url, '.meta'), 'w') as stream:
+    json.dump(meta, stream)
+
+
+def load_content(url):
+  try:
+    with open(get_cache_filename(url, '.data'), 'r') as stream:
+      return stream.read()
+  except IOError:
+    return False
+
+
+def save_content(url, content):
+  with open(get_cache_filename(url, '.data'), 'w') as stream:
+    stream.write(content)
+
+
+def fetch(url, ttl = 0):
+  """Fetch the content of url, revalidating an existing cached copy.
+
+  A cached copy younger than ttl seconds is used without any request. Older
+  copies are revalidated via If-None-Match/If-Modified-Since. Returns False,
+  if the content could not be fetched.
+  """
+  meta = load_meta(url)
+  cached = load_content(url) if meta else False
+
+  if cached is not False and ttl > 0 and time.time() - meta.get('fetched', 0) < ttl:
+    log.debug('Using cached %s, it is younger than %d secs' % (url, ttl))
+    return cached
+
+  request = urllib2.Request(url)
+  if cached is not False:
+    if meta.get('etag'):
+      request.add_header('If-None-Match', meta['etag'])
+    if meta.get('lastModified'):
+      request.add_header('If-Modified-Since', meta['lastModified'])
+
+  try:
+    response = urllib2.urlopen(request)
+    content = response.read()
+    headers = response.info()
+    meta = {
+      'etag': headers.getheader('ETag'),
+      'lastModified': headers.getheader('Last-Modified'),
+    }
+
+  except urllib2.HTTPError as err:
+    if err.code != 304 or cached is False:
+      log.debug('Could not read %s: %s' % (url, err))
+      return False
+
+    log.debug('%s not modified, using cached copy' % url)
+    content = cached
+
+  except Exception as err:
+    log.debug('Could not read %s: %s' % (url, err))
+    return False
+
+  meta['fetched'] = time.time()
+  try:
+    if content is not cached:
+      save_content(url, content)
+    save_meta(url, meta)
+  except (IOError, OSError) as err:
+    log.debug('Could not cache %s: %s' % (url, err))
+
+  return content
+
+
+def fetch_all(urls, ttl = 0):
+  """Fetch a list of urls concurrently, returns a dict keyed by url."""
+  results = {}
+  queue = Queue.Queue()
+  for url in urls:
+    queue.put(url)
+
+  def worker():
+    while True:
+      try:
+        url = queue.get_nowait()
+      except Queue.Empty:
+        return
+      results[url] = fetch(url, ttl)
+
+  threads = [ threading.Thread(target=worker) for i in range(min(max_workers, len(urls))) ]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  return results
+
+
+def is_url(value):
+  return isinstance(value, basestring) and (value[0:7] == 'http://' or value[0:8] == 'https://')
+
+
+def collect_urls(data, result = None):
+  """Collect all remote inheritsFrom- and docker-configuration-urls in data."""
+  if result is None:
+    result = set()
+
+  if isinstance(data, dict):
+    # Use only already loaded entries of lazy dicts.
+    for key, value in dict.iteritems(data):
+      if key == 'inheritsFrom':
+        items = [ value ] if isinstance(value, basestring) else value
+        for item in items:
+          if is_url(item):
+            result.add(item)
+      elif key == 'configuration' and is_url(value):
+        result.add(value)
+      else:
+        collect_urls(value, result)
+
+  elif isinstance(data, list):
+    for item in data:
+      collect_urls(item, result)
+
+  return result
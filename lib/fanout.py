@@ -0,0 +1,235 @@
+import logging
+log = logging.getLogger('fabric.fabalicious.fanout')
+
+import os
+import sys
+import time
+import fnmatch
+import tempfile
+import functools
+import multiprocessing
+import Queue
+
+from fabric.api import env
+
+from lib import configuration
+from lib import utils
+
+config_names = []
+max_workers = 4
+in_worker = False
+
+
+def select(patterns, available):
+  """Returns all configuration-names matching one of the (glob-)patterns."""
+  result = []
+  for pattern in patterns:
+    matches = sorted(fnmatch.filter(available, pattern))
+    if not matches:
+      log.error('No configuration found matching "%s"' % pattern)
+      exit(1)
+    for name in matches:
+      if name not in result:
+        result.append(name)
+
+  return result
+
+
+def enable(names, workers):
+  global config_names, max_workers
+  config_names = names
+  max_workers = max(1, int(workers))
+
+
+def is_enabled():
+  return len(config_names) > 0 and not in_worker
+
+
+def apply(name):
+  config = configuration.get(name)
+  configuration.apply(config, name)
+  if env.hosts:
+    env.host_string = env.hosts[0]
+
+
+def run_worker(name, work, result_queue):
+  global in_worker
+  in_worker = True
+
+  # Send all output of this host into a file, it gets printed in one block
+  # by the parent.
+  output_file = tempfile.NamedTemporaryFile(prefix='fabalicious-' + name + '-', suffix='.log', delete=False)
+  sys.stdout.flush()
+  sys.stderr.flush()
+  os.dup2(output_file.fileno(), 1)
+  os.dup2(output_file.fileno(), 2)
+
+  start_time = time.time()
+  success = False
+  try:
+    apply(name)
+    work(name)
+    success = True
+  except SystemExit as e:
+    success = not e.code
+  except BaseException as e:
+    log.error('%s failed: %s' % (name, e))
+  finally:
+    # Workers exit without running the atexit-handlers.
+    utils.close_tunnels()
+    utils.close_ssh_control_masters()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    result_queue.put((name, success, time.time() - start_time, output_file.name))
+
+
+def print_output(name, filename):
+  try:
+    with open(filename, 'r') as stream:
+      content = stream.read()
+    os.unlink(filename)
+  except (IOError, OSError):
+    content = ''
+
+  print "\n----- %s -----" % name
+  sys.stdout.write(content)
+  sys.stdout.flush()
+
+
+def run(names, work, workers = None):
+  """Run work(name) for every configuration name in its own process.
+
+  At most workers processes run at the same time, every process applies its
+  configuration first, so env and the method-state are isolated per host.
+  Returns a dict keyed by name with success and duration.
+  """
+  if workers is None:
+    workers = max_workers
+
+  # Resolve all configurations upfront, so the workers inherit them and
+  # invalid configurations get reported before anything runs.
+  for name in names:
+    configuration.get(name)
+
+  pending = [ name for name in names ]
+  running = {}
+  results = {}
+  result_queue = multiprocessing.Queue()
+
+  sys.stdout.flush()
+  sys.stderr.flush()
+
+  while pending or running:
+    while pending and len(running) < workers:
+      name = pending.pop(0)
+      process = multiprocessing.Process(target=run_worker, args=(name, work, result_queue))
+      process.start()
+      running[name] = (process, time.time())
+
+    dead = []
+    try:
+      reports = [ result_queue.get(timeout=1) ]
+    except Queue.Empty:
+      # Join exited workers first, their results might still be flushed into
+      # the queue, only workers without a result died.
+      dead = [ name for name, (process, start_time) in running.items() if not process.is_alive() ]
+      for name in dead:
+        running[name][0].join()
+      reports = drain(result_queue) if dead else []
+
+    for name, success, duration, filename in reports:
+      process, start_time = running.pop(name)
+      process.join()
+      results[name] = { 'success': success, 'duration': duration }
+      print_output(name, filename)
+
+    for name in dead:
+      if name in running:
+        process, start_time = running.pop(name)
+        results[name] = { 'success': False, 'duration': time.time() - start_time }
+        log.error('Worker for %s died with exit code %s' % (name, process.exitcode))
+
+  return results
+
+
+def drain(result_queue):
+  reports = []
+  while True:
+    try:
+      reports.append(result_queue.get(timeout=0.1))
+    except Queue.Empty:
+      return reports
+
+
+def rolling(names, work, health, batch_size, max_failures):
+  """Run work(name) in waves of batch_size configurations.
+
+  After every wave health(name) gets called for the succeeded configurations
+  of the wave. The rollout stops, if more than max_failures configurations
+  failed. Returns the results keyed by name, skipped configurations are
+  missing.
+  """
+  results = {}
+  failed = []
+  workers = min(batch_size, max_workers)
+  waves = [ names[i:i + batch_size] for i in range(0, len(names), batch_size) ]
+  for index, wave in enumerate(waves):
+    log.info('Wave %d/%d: %s' % (index + 1, len(waves), ', '.join(wave)))
+    wave_results = run(wave, work, workers)
+
+    succeeded = [ name for name in wave if wave_results[name]['success'] ]
+    if health and succeeded:
+      log.info('Checking health of %s' % ', '.join(succeeded))
+      health_results = run(succeeded, health, workers)
+      for name in succeeded:
+        wave_results[name]['duration'] += health_results[name]['duration']
+        if not health_results[name]['success']:
+          log.error('Health check failed for %s' % name)
+          wave_results[name]['success'] = False
+
+    results.update(wave_results)
+    failed += [ name for name in wave if not wave_results[name]['success'] ]
+    if len(failed) > max_failures:
+      log.error('%d configurations failed, exceeding the failure budget of %d, stopping the rollout.' % (len(failed), max_failures))
+      break
+
+  return results
+
+
+def print_results(names, results, wall_time):
+  print "\n{name:<40}  {status:<8}  {duration:>10}".format(name='configuration', status='status', duration='duration')
+  for name in names:
+    if name not in results:
+      print "{name:<40}  {status:<8}".format(name=name, status='skipped')
+      continue
+
+    result = results[name]
+    print "{name:<40}  {status:<8}  {duration:>8.1f} s".format(
+      name=name,
+      status='ok' if result['success'] else 'FAILED',
+      duration=result['duration'])
+
+  serial_time = sum(result['duration'] for result in results.values())
+  print "\nWall time: %.1f s, serial time: %.1f s" % (wall_time, serial_time)
+
+
+def task(fn):
+  """Decorator for fab-tasks, which runs the task for every configuration
+  selected by the configs-task in parallel."""
+
+  @functools.wraps(fn)
+  def wrapper(*args, **kwargs):
+    if not is_enabled():
+      return fn(*args, **kwargs)
+
+    log.info('Running %s on %d configurations with %d workers' % (fn.__name__, len(config_names), min(max_workers, len(config_names))))
+    start_time = time.time()
+    results = run(config_names, lambda name: fn(*args, **kwargs))
+    print_results(config_names, results, time.time() - start_time)
+
+    failed = [ name for name in config_names if not results[name]['success'] ]
+    if failed:
+      log.error('%s failed on %s' % (fn.__name__, ', '.join(failed)))
+      exit(1)
+
+  return wrapper
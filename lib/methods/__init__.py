@@ -1,60 +1,81 @@
 import logging
 log = logging.getLogger('fabric.fabalicious.methods')
 
-import inspect, sys
+import inspect, sys, importlib
 
-from types import TypeType
 from base import BaseMethod
-from git import GitMethod
-from drush import DrushMethod
-from ssh import SSHMethod
-from composer import ComposerMethod
-from scripts import ScriptMethod
-from docker import DockerMethod
-from slack import SlackMethod
-from files import FilesMethod
-from drupalconsole import DrupalConsoleMethod
-from platform import PlatformMethod
 
 from lib import plugins
 from lib import configuration
+from lib import timings
 
 cache = {}
-methodClasses = [
-  GitMethod,
-  DrushMethod,
-  SSHMethod,
-  ComposerMethod,
-  ScriptMethod,
-  DockerMethod,
-  SlackMethod,
-  FilesMethod,
-  DrupalConsoleMethod,
-  PlatformMethod
-]
-
-# Set global settings
-for method in methodClasses:
-  configuration.addGlobalSettings(method.getGlobalSettings())
-
-# get custom methods
-customMethods = plugins.getMethods(configuration.fabfile_basedir)
-for methodName, obj in customMethods.iteritems():
-  obj.setNameAndFactory(methodName, sys.modules[__name__])
-  configuration.addGlobalSettings(obj.getGlobalSettings())
-
-customMethods = customMethods.values()
+handlers = {}
+dispatchTables = {}
+runTaskDepth = 0
+
+# Maps the method-names to their implementing module and class, the modules
+# get imported on first use.
+methodModules = {
+  'git': ('git', 'GitMethod'),
+  'drush': ('drush', 'DrushMethod'),
+  'drush7': ('drush', 'DrushMethod'),
+  'drush8': ('drush', 'DrushMethod'),
+  'ssh': ('ssh', 'SSHMethod'),
+  'composer': ('composer', 'ComposerMethod'),
+  'script': ('scripts', 'ScriptMethod'),
+  'docker': ('docker', 'DockerMethod'),
+  'slack': ('slack', 'SlackMethod'),
+  'files': ('files', 'FilesMethod'),
+  'drupalconsole': ('drupalconsole', 'DrupalConsoleMethod'),
+  'platform': ('platform', 'PlatformMethod'),
+}
+
+methodClasses = {}
+customMethods = None
+
+
+def getMethodClass(name):
+  if name not in methodModules:
+    return False
+
+  module_name, class_name = methodModules[name]
+  if class_name not in methodClasses:
+    with timings.measure('import method %s' % module_name):
+      module = importlib.import_module(__name__ + '.' + module_name)
+      methodClass = getattr(module, class_name)
+
+    # Set global settings
+    configuration.addGlobalSettings(methodClass.getGlobalSettings())
+    methodClasses[class_name] = methodClass
+
+  return methodClasses[class_name]
+
+
+def getCustomMethods():
+  global customMethods
+
+  if customMethods is None:
+    with timings.measure('load method plugins'):
+      methods = plugins.getMethods(configuration.fabfile_basedir)
+    for methodName, obj in methods.iteritems():
+      obj.setNameAndFactory(methodName, sys.modules[__name__])
+      configuration.addGlobalSettings(obj.getGlobalSettings())
+
+    customMethods = methods.values()
+
+  return customMethods
 
 
 class Factory(object):
 
   @staticmethod
   def get(name):
-    for methodClass in methodClasses:
-      if methodClass.supports(name):
-        return methodClass(name, sys.modules[__name__])
+    methodClass = getMethodClass(name)
+    if methodClass and methodClass.supports(name):
+      return methodClass(name, sys.modules[__name__])
 
-    for customMethod in customMethods:
+    for customMethod in getCustomMethods():
       if customMethod.supports(name):
         return customMethod
 
@@ -64,8 +85,11 @@ class Factory(object):
 def getAllMethods():
   result = []
 
-  result.append(methodClasses)
-  result.append(customMethods)
+  for name in methodModules:
+    getMethodClass(name)
+
+  result.append(methodClasses.values())
+  result.append(getCustomMethods())
 
   return result
 
@@ -82,29 +106,72 @@ def getMethod(methodName):
   return m
 
 def get(methodName, taskName):
-  m = getMethod(methodName)
+  key = (methodName, taskName)
+  if key not in handlers:
+    m = getMethod(methodName)
+    fn = getattr(m, taskName, False)
+    handlers[key] = fn if fn and inspect.ismethod(fn) else False
 
-  if hasattr(m, taskName) and inspect.ismethod(getattr(m, taskName)):
-    return getattr(m, taskName)
+  return handlers[key]
 
-  return False
 
+class DispatchTable(object):
+  """Maps task-names to the handlers of a list of methods.
 
-def callImpl(methodName, taskName, configuration, optional, **kwargs):
-  overrides = {}
-  for need in configuration['needs']:
-    override = getMethod(need).getOverrides()
-    if override:
-      overrides[override] = need
+  The overrides and the handlers of a task get computed on first use and
+  are reused for every following call.
+  """
+
+  def __init__(self, needs):
+    self.needs = list(needs)
+    self.overrides = {}
+    self.tasks = {}
+    self.lookups = 0
+
+    for need in self.needs:
+      override = getMethod(need).getOverrides()
+      if override:
+        self.overrides[override] = need
+
+  def get(self, methodName, taskName):
+    self.lookups += 1
+    if methodName in self.overrides:
+      print "use override %s" % self.overrides[methodName]
+      methodName = self.overrides[methodName]
 
-  if methodName in overrides:
-    print "use override %s" % overrides[methodName]
-    methodName = overrides[methodName]
+    return get(methodName, taskName), methodName
 
+  def getHandlers(self, taskName):
+    """Returns a list of (methodName, handler, ownHandler) for every need.
+
+    handler has the overrides applied, ownHandler is the handler of the
+    method itself, both are False if not implemented.
+    """
+    self.lookups += 1
+    if taskName not in self.tasks:
+      result = []
+      for methodName in self.needs:
+        name = self.overrides.get(methodName, methodName)
+        result.append((methodName, get(name, taskName), get(methodName, taskName)))
+      self.tasks[taskName] = result
+
+    return self.tasks[taskName]
+
+
+def getDispatchTable(configuration):
+  key = tuple(configuration['needs'])
+  if key not in dispatchTables:
+    dispatchTables[key] = DispatchTable(key)
+
+  return dispatchTables[key]
+
+
+def callImpl(methodName, taskName, configuration, optional, **kwargs):
   # print "calling %s@%s ..." % (methodName, taskName)
-  fn = get(methodName, taskName)
+  fn, methodName = getDispatchTable(configuration).get(methodName, taskName)
   if fn:
-    result = fn(configuration, **kwargs)
+    with timings.span('%s.%s' % (methodName, taskName), 'method'):
+      result = fn(configuration, **kwargs)
     return result
   elif not optional:
     raise ValueError('Task "%s" in method "%s" not found!' % (taskName, methodName))
@@ -118,39 +185,52 @@ def call(methodName, taskName, configuration, **kwargs):
 
 
 def preflight(task, taskName, configuration, **kwargs):
-  for methodName in configuration['needs']:
-    fn = get(methodName, task)
-    if fn:
-      fn(taskName, configuration, **kwargs)
+  for methodName, fn, own_fn in getDispatchTable(configuration).getHandlers(task):
+    if own_fn:
+      with timings.span('%s.%s' % (methodName, task), 'method'):
+        own_fn(taskName, configuration, **kwargs)
 
 
 
 def runTask(configuration, taskName, **kwargs):
-  preflight('preflight', taskName, configuration, **kwargs)
-  runTaskImpl(configuration['needs'], taskName + "Prepare", configuration, False, **kwargs);
-  runTaskImpl(configuration['needs'], taskName, configuration, True, **kwargs);
+  global runTaskDepth
 
-  if 'nextTasks' in kwargs and len(kwargs['nextTasks']) > 0:
-    next_task = kwargs['nextTasks'].pop()
-    runTask(configuration, next_task, **kwargs)
+  table = getDispatchTable(configuration)
+  lookups = table.lookups
+  runTaskDepth += 1
+  try:
+    with timings.span(taskName, 'task', config=configuration['config_name']):
+      preflight('preflight', taskName, configuration, **kwargs)
+      runTaskImpl(configuration['needs'], taskName + "Prepare", configuration, False, **kwargs);
+      runTaskImpl(configuration['needs'], taskName, configuration, True, **kwargs);
 
-  runTaskImpl(configuration['needs'], taskName + "Finished", configuration, False, **kwargs);
-  preflight('postflight', taskName, configuration, **kwargs)
+      if 'nextTasks' in kwargs and len(kwargs['nextTasks']) > 0:
+        next_task = kwargs['nextTasks'].pop()
+        runTask(configuration, next_task, **kwargs)
+
+      runTaskImpl(configuration['needs'], taskName + "Finished", configuration, False, **kwargs);
+      preflight('postflight', taskName, configuration, **kwargs)
+  finally:
+    runTaskDepth -= 1
+
+  if runTaskDepth == 0:
+    log.debug('Task %s on configuration %s needed %d dispatch lookups' % (taskName, configuration['config_name'], table.lookups - lookups))
 
 
 def runTaskImpl(methodNames, taskName, configuration, fallback_allowed, **kwargs):
-  msg_printed = False
+  if not 'quiet' in kwargs and len(methodNames) > 0:
+    log.info('Running task %s on configuration %s' % (taskName, configuration['config_name']))
+
+  table = getDispatchTable(configuration) if methodNames is configuration['needs'] else DispatchTable(methodNames)
   fn_called = False
-  for methodName in methodNames:
-    if not 'quiet' in kwargs and not msg_printed:
-      log.info('Running task %s on configuration %s' % (taskName, configuration['config_name']))
-      msg_printed = True
-    fn = get(methodName, taskName)
-    if fn:
+  for methodName, fn, own_fn in table.getHandlers(taskName):
+    if own_fn:
       fn_called = True
-    callImpl(methodName, taskName, configuration, True, **kwargs)
+    if fn:
+      with timings.span('%s.%s' % (methodName, taskName), 'method'):
+        fn(configuration, **kwargs)
   if not fn_called and fallback_allowed:
-    for methodName in methodNames:
-      fn = get(methodName, 'fallback')
-      if fn:
-        fn(taskName, configuration, **kwargs)
+    for methodName, fn, own_fn in table.getHandlers('fallback'):
+      if own_fn:
+        with timings.span('%s.fallback(%s)' % (methodName, taskName), 'method'):
+          own_fn(taskName, configuration, **kwargs)
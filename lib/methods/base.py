@@ -7,6 +7,9 @@ from fabric.context_managers import env
 from fabric.network import *
 from fabric.contrib.files import exists
 import re
+import pipes
+from lib import timings
+from lib import backup_catalog
 
 
 class LocallyContext():
@@ -105,23 +108,18 @@ class BaseMethod(object):
 
 
   def list_remote_files(self, base_folder, patterns):
-    result = []
-    with cd(base_folder), hide('running', 'output', 'warnings'), warn_only():
-      for pattern in patterns:
-        cmd = 'ls -l ' + pattern + ' 2>/dev/null'
-        output = run(cmd)
-        lines = output.stdout.splitlines()
-        for line in lines:
-          tokens = line.split()
-
-          if(len(tokens) >= 9):
-            result.append(tokens[8])
-    return result
+    # One name per line, so names with spaces survive, all patterns at once.
+    cmd = 'cd {folder} && for f in {patterns}; do [ -e "$f" ] && echo "$f"; done; true'.format(
+      folder=pipes.quote(base_folder),
+      patterns=' '.join(patterns))
+    with hide('running', 'output', 'warnings'), warn_only():
+      output = self.run(cmd, capture=True)
+    return [ line.rstrip('\r') for line in output.stdout.splitlines() if line.strip() ]
 
 
   def get_backup_result(self, config, file, hash, method):
     tokens = hash.split('--')
-    if len(tokens) < 3:
+    if len(tokens) < 4:
       return False
     # be backwards compatible.
     if tokens[0] != config['config_name']:
@@ -140,6 +138,16 @@ class BaseMethod(object):
     }
 
 
+  def add_to_backup_catalog(self, config, file, hash, method):
+    # The backup exists already, a broken catalog must not fail it.
+    try:
+      result = self.get_backup_result(config, file, hash, method)
+      if result:
+        backup_catalog.add(config, result)
+    except (Exception, SystemExit) as e:
+      log.warning('Could not add %s to the backup catalog, run rebuildBackupCatalog: %s' % (file, e))
+
+
   def get_backup_result_for_method(self, files, method):
     file = filter(lambda f: f['method'] == method, files)
     if len(file) != 1:
@@ -186,18 +194,28 @@ class BaseMethod(object):
     # log.error("run: %d %s" % ( self.run_locally, cmd))
     cmd = self.expandCommand(cmd)
 
+    with timings.span(cmd, 'command', local=self.run_locally) as span:
+      if self.run_locally:
+        result = local(cmd, **kwargs)
+      else:
+        if 'capture' in kwargs:
+          kwargs.pop('capture')
+        result = run(cmd, **kwargs)
+      span.setExitCode(result.return_code)
+
+    return result
+
+  def run_pipe(self, cmd, **kwargs):
+    # Let the pipe fail if any of its commands fail, local() needs bash for that.
     if self.run_locally:
-      return local(cmd, **kwargs)
-    else:
-      if 'capture' in kwargs:
-        kwargs.pop('capture')
-      return run(cmd, **kwargs)
+      kwargs['shell'] = '/bin/bash'
+    return self.run('set -o pipefail; ' + cmd, **kwargs)
 
   def exists(self, fname):
     return os.path.isfile(fname) if self.run_locally else exists(fname)
 
 
-  def run_quietly(self, cmd, msg = '', hide_output = None, may_fail=False):
+  def run_quietly(self, cmd, msg = '', hide_output = None, may_fail=False, pipe=False):
     if 'warn_only' in env and env['warn_only']:
       may_fail = True
 
@@ -213,7 +231,7 @@ class BaseMethod(object):
 
     with hide(*hide_output):
       try:
-        result = self.run(cmd)
+        result = self.run_pipe(cmd) if pipe else self.run(cmd)
 
         if not may_fail and result.return_code != 0:
           log.error('%s failed:' %s)
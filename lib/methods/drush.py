@@ -8,10 +8,16 @@ from fabric.network import *
 from fabric.context_managers import settings as _settings
 from lib import configuration
 from lib import utils
+from lib import compression
 import re
+import os
+import pipes
 from lib.utils import validate_dict
 from fabric.api import get
 import tempfile
+import time
+import json
+from StringIO import StringIO
 
 
 class DrushMethod(BaseMethod):
@@ -38,6 +44,8 @@ class DrushMethod(BaseMethod):
         'cache_views_data',
       ],
       'revertFeatures': True,
+      'sqlCopyMode': 'file',
+      'sqlDumpWorkers': 1,
       'configurationManagement': {
         'staging': [
           '#!drush config-import -y staging'
@@ -66,6 +74,8 @@ class DrushMethod(BaseMethod):
   def getDefaultConfig(config, settings, defaults):
     defaults['adminUser'] = settings['adminUser'] if 'adminUser' in settings else 'admin'
     defaults['revertFeatures'] = settings['revertFeatures']
+    defaults['sqlCopyMode'] = settings['sqlCopyMode']
+    defaults['sqlDumpWorkers'] = settings['sqlDumpWorkers']
     defaults['configurationManagement'] = settings['configurationManagement']
     defaults['database'] = { "skipCreateDatabase": False }
     defaults['installOptions'] = settings['installOptions']
@@ -86,7 +96,7 @@ class DrushMethod(BaseMethod):
     if 'skipCreateDatabase' not in config['database']:
       config['database']['skipCreateDatabase'] = False
 
-    BaseMethod.addExecutables(config, ['drush', 'mysql', 'mysqladmin', 'gunzip', 'rsync', 'scp', 'grep'])
+    BaseMethod.addExecutables(config, ['drush', 'mysql', 'mysqladmin', 'gunzip', 'rsync', 'scp', 'ssh', 'grep', 'pv'] + compression.executables)
 
 
   def handle_modules(self, config, file, enable):
@@ -186,7 +196,7 @@ class DrushMethod(BaseMethod):
           self.run_drush(' cc all')
 
 
-  def run_drush(self, cmd, expand_command = True):
+  def run_drush(self, cmd, expand_command = True, pipe = False):
     env.output_prefix = False
     if expand_command:
       cmd = '#!drush ' + cmd
@@ -195,26 +205,117 @@ class DrushMethod(BaseMethod):
       args = []
 
     with hide(*args):
-      self.run(cmd)
+      if pipe:
+        self.run_pipe(cmd)
+      else:
+        self.run(cmd)
     env.output_prefix = True
 
 
+  def getDumpOptions(self):
+    if configuration.getSettings('sqlSkipTables'):
+      return '--structure-tables-list=' + ','.join(configuration.getSettings('sqlSkipTables'))
+    return ''
+
+
+  def getBackupExtension(self, config):
+    return compression.get(config).extension if config['supportsZippedBackups'] else ''
+
+
   def backupSql(self, config, backup_file_name):
     self.setRunLocally(config)
 
     with self.cd(config['siteFolder']):
       with warn_only():
-        dump_options = ''
-        if configuration.getSettings('sqlSkipTables'):
-          dump_options = '--structure-tables-list=' + ','.join(configuration.getSettings('sqlSkipTables'))
+        dump_options = self.getDumpOptions()
 
         self.run_quietly('mkdir -p ' + config['backupFolder'])
         self.run_quietly('rm -f '+backup_file_name)
         if config['supportsZippedBackups']:
-          self.run_quietly('rm -f '+backup_file_name+'.gz')
-          dump_options += ' --gzip'
+          self.run_quietly('rm -f '+backup_file_name+self.getBackupExtension(config))
+
+      if config['supportsZippedBackups']:
+        self.run_drush('sql-dump {options} | {compress} > {file}'.format(
+          options=dump_options,
+          compress=compression.get(config).compress(),
+          file=backup_file_name + self.getBackupExtension(config)), pipe=True)
+      else:
+        self.run_drush('sql-dump ' + dump_options + ' --result-file=' + backup_file_name)
+
+
+  def getTables(self, config):
+    with self.cd(config['siteFolder']), hide('running', 'output'), warn_only():
+      output = self.run('#!drush sql-query "SHOW TABLES" --extra=--skip-column-names', capture=True)
+    if output.return_code != 0:
+      return []
+
+    return [ line.strip() for line in output.splitlines() if line.strip() ]
+
+
+  def getUnsupportedTables(self, tables):
+    # Table-names get passed unquoted through the shell, so allow only safe ones.
+    unsupported = [ t for t in tables if not re.match('^[\w-]+$', t) ]
+    if unsupported:
+      log.warning('Unsupported table-names: %s' % ', '.join(unsupported))
+    return unsupported
+
+
+  def writeFile(self, filename, content):
+    if self.run_locally:
+      with open(filename, 'w') as stream:
+        stream.write(content)
+    else:
+      put(StringIO(content), filename)
+
+
+  def readFile(self, filename):
+    with hide('running', 'output'):
+      return self.run('cat %s' % filename, capture=True)
+
+
+  def backupSqlParallel(self, config, backup_dir_name, workers):
+    """Dump every table into its own file, using workers concurrent dumps.
 
-      self.run_drush('sql-dump ' + dump_options + ' --result-file=' + backup_file_name)
+    The folder contains a manifest.json listing all tables, tables from
+    sqlSkipTables get dumped without data. Every worker dumps in its own
+    transaction, so the backup is not a snapshot of one point in time.
+    """
+    self.setRunLocally(config)
+
+    tables = self.getTables(config)
+    if not tables or self.getUnsupportedTables(tables):
+      return False
+
+    skip_tables = configuration.getSettings('sqlSkipTables') or []
+    manifest = {
+      'format': 1,
+      'tables': tables,
+      'structureOnly': [ t for t in tables if t in skip_tables ],
+      'zipped': config['supportsZippedBackups'],
+      'extension': self.getBackupExtension(config)
+    }
+
+    self.run_quietly('rm -rf {folder} && mkdir -p {folder}'.format(folder=backup_dir_name))
+    self.writeFile(backup_dir_name + '/manifest.json', json.dumps(manifest, indent=2))
+
+    if manifest['zipped']:
+      dump_cmd = "bash -c 'set -o pipefail; #!drush sql-dump --tables-list={}{options} | " + compression.get(config).compress() + " > " + backup_dir_name + "/{}.sql" + manifest['extension'] + "'"
+    else:
+      dump_cmd = '#!drush sql-dump --tables-list={}{options} --result-file=' + backup_dir_name + '/{}.sql'
+
+    structure_tables = manifest['structureOnly']
+    data_tables = [ t for t in tables if t not in structure_tables ]
+
+    with self.cd(config['siteFolder']):
+      for table_names, options in [ (structure_tables, ' --extra=--no-data'), (data_tables, '') ]:
+        if table_names:
+          cmd = "printf '%s\\n' {tables} | xargs -P {workers} -I {{}} {dump_cmd}".format(
+            tables=' '.join(table_names),
+            workers=workers,
+            dump_cmd=dump_cmd.replace('{options}', options))
+          self.run_drush(cmd, False)
+
+    return True
 
 
   def drush(self, config, **kwargs):
@@ -228,15 +329,26 @@ class DrushMethod(BaseMethod):
 
     baseName = kwargs['baseName']
     filename = config['backupFolder'] + "/" + '--'.join(baseName) + ".sql"
+
+    workers = int(config['sqlDumpWorkers'])
+    if workers > 1:
+      if self.backupSqlParallel(config, filename + 'dir', workers):
+        log.info('Database dump at "%s"' % (filename + 'dir'))
+        self.add_to_backup_catalog(config, os.path.basename(filename + 'dir'), '--'.join(baseName), 'drush')
+        return
+      log.warning('Could not dump the tables in parallel, dumping into a single file')
+
     self.backupSql(config, filename)
-    if config['supportsZippedBackups']:
-      filename += '.gz'
+    filename += self.getBackupExtension(config)
     log.info('Database dump at "%s"' % filename)
+    self.add_to_backup_catalog(config, os.path.basename(filename), '--'.join(baseName), 'drush')
 
   def listBackups(self, config, results, **kwargs):
-    files = self.list_remote_files(config['backupFolder'], ['*.sql', '*.sql.gz'])
+    self.setRunLocally(config)
+    extensions = [ '.sql' + e for e in compression.get_extensions() ] + [ '.sql', '.sqldir' ]
+    files = self.list_remote_files(config['backupFolder'], [ '*' + e for e in extensions ])
     for file in files:
-      hash = re.sub('\.(sql\.gz|sql)$', '', file)
+      hash = compression.strip_extension(file, extensions)
       backup_result = self.get_backup_result(config, file, hash, 'drush')
       if backup_result:
         results.append(backup_result)
@@ -252,28 +364,225 @@ class DrushMethod(BaseMethod):
 
 
   def importSQLFromFile(self, config, sql_name_target, cleanupBeforeRestore=False):
+    if sql_name_target.endswith('.sqldir'):
+      return self.importSQLFromDir(config, sql_name_target, cleanupBeforeRestore)
 
     with self.runLocally(config), self.cd(config['siteFolder']):
       if cleanupBeforeRestore:
         self.run_drush('sql-drop -y')
 
-      if config['supportsZippedBackups']:
-        self.run_drush('#!gunzip -c '+ sql_name_target + ' | $(#!drush sql-connect)', False)
+      file_compression = compression.for_file(config, sql_name_target)
+      if file_compression:
+        self.run_drush(file_compression.decompress() + ' ' + sql_name_target + ' | $(#!drush sql-connect)', False, pipe=True)
       else:
         self.run_drush('sql-cli < ' + sql_name_target)
 
       log.info('SQL restored from "%s"' % sql_name_target)
 
 
-  def copyDBFrom(self, config, source_config=False, **kwargs):
+  def importSQLFromDir(self, config, sql_dir_name, cleanupBeforeRestore=False):
+    with self.runLocally(config), self.cd(config['siteFolder']):
+      manifest = json.loads(self.readFile(sql_dir_name + '/manifest.json'))
+
+      if cleanupBeforeRestore:
+        self.run_drush('sql-drop -y')
+
+      if manifest['zipped']:
+        extension = manifest.get('extension', '.gz')
+        reader = compression.for_file(config, extension).decompress() + ' {folder}/{{}}.sql' + extension
+      else:
+        reader = 'cat {folder}/{{}}.sql'
+
+      cmd = 'CONNECT=$(#!drush sql-connect) && printf \'%s\\n\' {tables} | xargs -P {workers} -I {{}} bash -c "set -o pipefail; {reader} | $CONNECT"'.format(
+        tables=' '.join(manifest['tables']),
+        workers=max(1, int(config['sqlDumpWorkers'])),
+        reader=reader.format(folder=sql_dir_name))
+      with hide('running'), warn_only():
+        result = self.run_pipe(cmd)
+
+      if result.return_code != 0:
+        log.error('Could not restore SQL from "%s"' % sql_dir_name)
+        exit(1)
+
+      log.info('SQL restored from "%s"' % sql_dir_name)
+
+
+  def copyDBFrom(self, config, source_config=False, sqlCopyMode=False, **kwargs):
+    self.setRunLocally(config)
+
+    mode = sqlCopyMode or config['sqlCopyMode']
+    if mode in ['stream', 'incremental']:
+      if source_config['runLocally'] or 'ssh' not in source_config['needs']:
+        log.info('Can\'t stream the database from %s, copying a dump-file instead' % source_config['config_name'])
+      elif mode == 'incremental' and self.syncDBFrom(config, source_config):
+        return
+      elif mode == 'stream' and self.streamDBFrom(config, source_config):
+        return
+      else:
+        log.warning('Streaming the database failed, copying a dump-file instead')
+
+    self.copyDBFromViaFile(config, source_config)
+
+
+  def queryRows(self, config, query):
+    with self.cd(config['siteFolder']), hide('running', 'output'), warn_only():
+      output = self.run('#!drush sql-query "%s" --extra=--skip-column-names' % query, capture=True)
+    if output.return_code != 0:
+      return False
+
+    return [ line.strip().split('\t') for line in output.splitlines() if '\t' in line ]
+
+
+  def getTableChecksums(self, config):
+    """Returns checksum and size per table, False on errors."""
+    tables = self.getTables(config)
+    if not tables:
+      return {}
+    if self.getUnsupportedTables(tables):
+      return False
+
+    checksums = self.queryRows(config, 'CHECKSUM TABLE ' + ', '.join('\\`%s\\`' % t for t in tables))
+    sizes = self.queryRows(config, 'SELECT table_name, data_length + index_length FROM information_schema.tables WHERE table_schema = DATABASE()')
+    if checksums is False or sizes is False:
+      return False
+
+    sizes = dict((row[0], int(row[1]) if row[1].isdigit() else 0) for row in sizes if len(row) == 2)
+    result = {}
+    for row in checksums:
+      if len(row) == 2:
+        table = row[0].split('.', 1)[-1]
+        result[table] = { 'checksum': row[1], 'size': sizes.get(table, 0) }
+    return result
+
+
+  def syncDBFrom(self, config, source_config):
+    """Copy only the tables whose checksum differs between source and target.
+
+    The checksums are compared live and not stored, so tables of a failed
+    batch still differ and get copied again by the next sync.
+    """
+    start_time = time.time()
+
+    source_host_string = join_host_strings(source_config['user'], source_config['host'], source_config['port'])
+    with _settings(host_string=source_host_string), self.runLocally(source_config):
+      source_tables = self.getTableChecksums(source_config)
     self.setRunLocally(config)
+    target_tables = self.getTableChecksums(config)
+
+    if not source_tables or target_tables is False:
+      return False
+
+    changed = [ t for t in sorted(source_tables) if t not in target_tables or source_tables[t]['checksum'] != target_tables[t]['checksum'] ]
+    removed = [ t for t in sorted(target_tables) if t not in source_tables ]
+
+    skip_tables = configuration.getSettings('sqlSkipTables') or []
+    structure_tables = [ t for t in changed if t in skip_tables ]
+    data_tables = [ t for t in changed if t not in skip_tables ]
+
+    log.info('%d of %d tables changed, %d tables to remove' % (len(changed), len(source_tables), len(removed)))
+
+    if structure_tables and not self.streamDBFrom(config, source_config, structure_tables, True):
+      return False
+    if data_tables and not self.streamDBFrom(config, source_config, data_tables):
+      return False
+
+    # Change the target only after all batches were copied successfully.
+    self.dropTables(config, removed)
+
+    total_size = sum(t['size'] for t in source_tables.values())
+    copied_size = sum(source_tables[t]['size'] for t in data_tables)
+    duration = time.time() - start_time
+    log.info('Synced database from %s in %.1f s, copied %.1f MB of %.1f MB' % (source_config['config_name'], duration, copied_size / 1048576.0, total_size / 1048576.0))
+    if copied_size > 0:
+      log.info('Estimated time saved: %.1f s' % (duration * (total_size - copied_size) / copied_size))
 
+    return True
+
+
+  def dropTables(self, config, tables):
+    unsupported = self.getUnsupportedTables(tables)
+    tables = [ t for t in tables if t not in unsupported ]
+    if tables:
+      with self.cd(config['siteFolder']):
+        self.run_drush('sql-query "DROP TABLE %s"' % ', '.join('\\`%s\\`' % t for t in tables))
+
+
+  def streamDBFrom(self, config, source_config, tables = False, structure_only = False):
+    """Pipe sql-dump of the source via ssh directly into the target database.
+
+    The data is compressed on the wire only, nothing gets written to disk.
+    If tables is set, only these tables get copied.
+    """
+    if tables:
+      dump_options = '--tables-list=' + ','.join(tables)
+      if structure_only:
+        dump_options += ' --extra=--no-data'
+    else:
+      dump_options = self.getDumpOptions()
+
+    # Build the dump-command with the executables of the source.
+    self.setExecutables(source_config)
+    wire_compression = compression.get(source_config)
+    dump_cmd = self.expandCommand('#!drush sql-dump ' + dump_options)
+    compress_cmd = self.expandCommand(wire_compression.compress())
+    self.setExecutables(config)
+
+    args = utils.ssh_no_strict_key_host_checking_params
+    args += utils.get_ssh_multiplexing_params(source_config['user'], source_config['host'], source_config['port'], not self.run_locally)
+
+    with hide('running', 'output', 'warnings'), warn_only():
+      has_pv = self.run('command -v %s' % self.executables['pv']).return_code == 0
+
+    # The remote pipe needs pipefail as well, otherwise a failing sql-dump
+    # gets imported as an empty stream.
+    remote_cmd = 'cd {siteFolder} && bash -c {pipe}'.format(
+      pipe=pipes.quote('set -o pipefail; ' + dump_cmd + ' | ' + compress_cmd),
+      **source_config)
+    cmd = '#!ssh {args}-p {port} {user}@{host} {remote_cmd}'.format(
+      args=args,
+      remote_cmd=pipes.quote(remote_cmd),
+      **source_config
+    )
+    if has_pv:
+      cmd += ' | #!pv -f -t -b -r'
+    cmd += ' | ' + wire_compression.decompress() + ' | $(#!drush sql-connect)'
+
+    log.info('Streaming %s from %s to %s' % (
+      ('%d tables' % len(tables)) if tables else 'database',
+      source_config['config_name'],
+      config['config_name']))
+    start_time = time.time()
+
+    if not tables:
+      source_host_string = join_host_strings(source_config['user'], source_config['host'], source_config['port'])
+      with _settings(host_string=source_host_string), self.runLocally(source_config):
+        source_tables = self.getTables(source_config)
+      self.setRunLocally(config)
+      if not source_tables:
+        return False
+
+    with self.cd(config['siteFolder']), warn_only():
+      result = self.run_pipe(cmd)
+
+    # The target is left as it is on errors, copyDBFrom replaces it with a
+    # dump-file then.
+    if result.return_code != 0:
+      return False
+
+    if not tables:
+      # A full copy replaces the database like importing a dump-file does.
+      self.dropTables(config, [ t for t in self.getTables(config) if t not in source_tables ])
+
+    log.info('Streamed from %s in %.1f s' % (source_config['config_name'], time.time() - start_time))
+    return True
+
+
+  def copyDBFromViaFile(self, config, source_config):
     target_config = config
     sql_name_source = source_config['tmpFolder'] + '/' + config['config_name'] + '.sql'
     sql_name_target = target_config['tmpFolder'] + '/' + config['config_name'] + '_target.sql'
 
-    if source_config['supportsZippedBackups']:
-      sql_name_target += '.gz'
+    sql_name_target += self.getBackupExtension(source_config)
 
     source_host_string = join_host_strings(source_config['user'], source_config['host'], source_config['port'])
 
@@ -282,10 +591,10 @@ class DrushMethod(BaseMethod):
       self.backupSql(source_config, sql_name_source)
 
     # copy dump to target:
-    if source_config['supportsZippedBackups']:
-      sql_name_source += '.gz'
+    sql_name_source += self.getBackupExtension(source_config)
 
     args = utils.ssh_no_strict_key_host_checking_params
+    args += utils.get_ssh_multiplexing_params(source_config['user'], source_config['host'], source_config['port'], not self.run_locally)
 
     cmd = '#!scp -P {port} {args} {user}@{host}:{sql_name_source} {sql_name_target} '.format(  args=args,
       sql_name_source=sql_name_source,
@@ -305,10 +614,9 @@ class DrushMethod(BaseMethod):
 
     targetSQLFileName = config['tmpFolder'] + '/manual_upload.sql'
 
-    fileName, fileExtension = os.path.splitext(sourceFile)
-    zipped = fileExtension == '.gz'
-    if zipped:
-      targetSQLFileName += '.gz'
+    file_compression = compression.for_file(config, sourceFile)
+    if file_compression:
+      targetSQLFileName += file_compression.extension
 
     if config['runLocally']:
       local('cp %s %s' % (sourceFile, targetSQLFileName))
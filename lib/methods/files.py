@@ -6,10 +6,16 @@ from fabric.api import *
 import datetime
 import os.path
 import re
+import pipes
+import time
+import fnmatch
 from lib import utils
 from lib import configuration
+from lib import compression
 from lib.utils import validate_dict
 from fabric.contrib.files import exists
+from fabric.network import join_host_strings
+from fabric.context_managers import settings as _settings
 
 class FilesMethod(BaseMethod):
   @staticmethod
@@ -20,9 +26,17 @@ class FilesMethod(BaseMethod):
   def validateConfig(config):
     return validate_dict(['rootFolder', 'siteFolder', 'filesFolder', 'backupFolder'], config)
 
+  @staticmethod
+  def getGlobalSettings():
+    return {
+      'filesBackupMode': 'tar',
+      'rsyncWorkers': 1
+    }
+
   @staticmethod
   def getDefaultConfig(config, settings, defaults):
-    pass
+    defaults['filesBackupMode'] = settings['filesBackupMode']
+    defaults['rsyncWorkers'] = settings['rsyncWorkers']
 
   @staticmethod
   def applyConfig(config, settings):
@@ -31,7 +45,10 @@ class FilesMethod(BaseMethod):
       if key in config and config[key].find(config['rootFolder']) < 0:
         config[key] = config['rootFolder'] + config[key]
 
-    BaseMethod.addExecutables(config, ['tar', 'rsync'])
+    BaseMethod.addExecutables(config, ['tar', 'rsync', 'find', 'sha1sum'] + compression.executables)
+
+  manifest_extension = '.files.manifest'
+  snapshot_extension = '.snapshot'
 
 
   def tarFiles(self, config, filename, source_folders, type):
@@ -40,9 +57,20 @@ class FilesMethod(BaseMethod):
     cmd = '#!tar'
     if excludeFiles:
       cmd += ' --exclude="'  + '" --exclude="'.join(excludeFiles) + '"'
-    cmd += ' -czPf ' + filename
-    cmd += ' ' + ' '.join(source_folders)
-    self.run_quietly(cmd)
+    cmd += ' -cPf - ' + ' '.join(source_folders)
+    cmd += ' | ' + compression.get(config).compress() + ' > ' + filename
+    self.run_quietly(cmd, pipe=True)
+
+  def getSourceFolders(self, config):
+    source_folders = []
+    if 'filesFolder' in config:
+      source_folders.append(config['filesFolder'])
+    if 'privateFilesFolder' in config:
+      source_folders.append(config['privateFilesFolder'])
+    return source_folders
+
+  def getObjectStore(self, config):
+    return config['backupFolder'] + '/files-objects'
 
   def backup(self, config, **kwargs):
     self.setRunLocally(config)
@@ -50,20 +78,161 @@ class FilesMethod(BaseMethod):
       return
 
     baseName = kwargs['baseName']
-    filename = config['backupFolder'] + "/" + '--'.join(baseName) + ".tgz"
+    if not self.getSourceFolders(config):
+      return
+
+    if config['filesBackupMode'] == 'dedup':
+      filename = config['backupFolder'] + "/" + '--'.join(baseName) + self.manifest_extension
+      self.backupFilesDedup(config, filename, self.getSourceFolders(config))
+    elif config['filesBackupMode'] == 'snapshot':
+      filename = config['backupFolder'] + "/" + '--'.join(baseName) + self.snapshot_extension
+      self.backupFilesSnapshot(config, filename, self.getSourceFolders(config))
+    else:
+      filename = config['backupFolder'] + "/" + '--'.join(baseName) + compression.get(config).tarExtension
+      self.backupFiles(config, backup_file_name=filename)
 
-    self.backupFiles(config, backup_file_name=filename)
+    self.add_to_backup_catalog(config, os.path.basename(filename), '--'.join(baseName), 'files')
+
+
+  def backupFilesDedup(self, config, manifest_file_name, source_folders):
+    """Backs up source_folders into a content-addressed object store.
+
+    Every file is stored once under its sha1 in the object store of the
+    backupFolder, the manifest lists the directories, the symlinks and the
+    hash of every file, so backups only add new or changed files to the store.
+    """
+    if not source_folders:
+      return
+
+    excludeFiles = configuration.getSettings('excludeFiles')
+    excludeFiles = excludeFiles['backup'] if excludeFiles and 'backup' in excludeFiles else False
+    find_cmd = '#!find ' + ' '.join(source_folders)
+    if excludeFiles:
+      find_cmd += ' \\( -name "' + '" -o -name "'.join(excludeFiles) + '" \\) -prune -o'
+
+    store = self.getObjectStore(config)
+    files_in_manifest = "awk -F'\\t' '$1 == \"F\"' {manifest}.tmp"
+    cmd = ' && '.join([
+      'mkdir -p {store}',
+      # sha1sum -z does not escape special characters in filenames.
+      "{{ {find} -type d -print | sed 's/^/D\\t/'; {find} -type l -printf 'L\\t%l\\t%p\\n'; {find} -type f -print0 | xargs -0 -r #!sha1sum -z | tr '\\0' '\\n' | sed 's/^\\([0-9a-f]*\\)  /F\\t\\1\\t/'; }} > {manifest}.tmp",
+      # The manifest is line-based, so refuse filenames it can't represent.
+      "if grep -v -E $'^(D\\t|L\\t[^\\t]*\\t|F\\t[0-9a-f]{{40}}\\t)' {manifest}.tmp; then echo 'Can not back up the filenames above'; exit 1; fi",
+      'new=$(' + files_in_manifest + ' | while IFS=$\'\\t\' read -r type hash path; do' +
+        ' obj={store}/${{hash:0:2}}/$hash;' +
+        ' if [ ! -e "$obj" ]; then mkdir -p {store}/${{hash:0:2}} && cp -p "$path" "$obj.tmp" && mv "$obj.tmp" "$obj" && echo "$obj" || exit 1; fi;' +
+        ' done | wc -l)',
+      'total=$(' + files_in_manifest + ' | wc -l)',
+      'mv {manifest}.tmp {manifest}',
+      'echo "$new $total"'
+    ]).format(find=find_cmd, store=store, manifest=manifest_file_name)
+
+    with hide('running', 'output'), warn_only():
+      result = self.run_pipe(cmd, capture=True)
+
+    if result.return_code != 0:
+      log.error('Could not back up files into "%s": %s' % (store, result))
+      exit(1)
+
+    new_files, total_files = result.stdout.strip().splitlines()[-1].split()
+    log.info('Files dumped into "%s", %s of %s files were new' % (manifest_file_name, new_files, total_files))
+
+
+  def backupFilesSnapshot(self, config, snapshot_name, source_folders):
+    """Backs up source_folders into a snapshot-folder.
+
+    Files unchanged since the latest snapshot get hardlinked via rsync's
+    --link-dest, so they need no additional space.
+    """
+    if not source_folders:
+      return
+
+    excludeFiles = configuration.getSettings('excludeFiles')
+    excludeFiles = excludeFiles['backup'] if excludeFiles and 'backup' in excludeFiles else False
+    rsync_args = ''
+    if excludeFiles:
+      rsync_args = ' --exclude "' + '" --exclude "'.join(excludeFiles) + '"'
+
+    # Write into a temporary folder, so an aborted snapshot never serves as
+    # --link-dest for the next one.
+    cmd = ' && '.join([
+      'rm -rf {snapshot}.tmp',
+      'mkdir -p {snapshot}.tmp',
+      'previous=$(cd {backupFolder} && ls -1dt *{extension} 2>/dev/null | head -n 1 || true)',
+      'link_dest=""',
+      'if [ -n "$previous" ]; then link_dest="--link-dest={backupFolder}/$previous"; fi',
+      '#!rsync -aR --stats $link_dest{rsync_args} {folders} {snapshot}.tmp/',
+      'mv {snapshot}.tmp {snapshot}',
+      'echo "previous: $previous"'
+    ]).format(
+      backupFolder=config['backupFolder'],
+      extension=self.snapshot_extension,
+      snapshot=snapshot_name,
+      rsync_args=rsync_args,
+      folders=' '.join(source_folders))
+
+    with hide('running', 'output'), warn_only():
+      result = self.run_pipe(cmd, capture=True)
+
+    if result.return_code != 0:
+      log.error('Could not create snapshot "%s": %s' % (snapshot_name, result))
+      exit(1)
+
+    previous = re.search('^previous:(.*)$', result.stdout, re.MULTILINE).group(1).strip()
+    transferred = re.search('^Total transferred file size: ([\d,.]+)', result.stdout, re.MULTILINE)
+    log.info('Files dumped into "%s"%s%s' % (
+      snapshot_name,
+      (', unchanged files linked to ' + previous) if previous else '',
+      (', %s bytes copied' % transferred.group(1)) if transferred else ''))
+
+
+  def restoreFilesSnapshot(self, config, snapshot_name):
+    cmds = []
+    for folder in self.getSourceFolders(config):
+      cmds.append('if [ -d {snapshot}{folder} ]; then #!rsync -a --delete {snapshot}{folder}/ {folder}/; fi'.format(
+        snapshot=snapshot_name,
+        folder=folder))
+
+    self.run_quietly(' && '.join(cmds), 'Restoring files', pipe=True)
+
+
+  def restoreFilesDedup(self, config, manifest_file_name):
+    store = self.getObjectStore(config)
+    cmd = ' && '.join([
+      "awk -F'\\t' '$1 == \"D\" {{ print $2 }}' {manifest} | while IFS= read -r dir; do mkdir -p \"$dir\" || exit 1; done",
+      "awk -F'\\t' '$1 == \"F\"' {manifest} | while IFS=$'\\t' read -r type hash path; do cp -p \"{store}/${{hash:0:2}}/$hash\" \"$path\" || exit 1; done",
+      "awk -F'\\t' '$1 == \"L\"' {manifest} | while IFS=$'\\t' read -r type target path; do ln -sfn \"$target\" \"$path\" || exit 1; done"
+    ]).format(store=store, manifest=manifest_file_name)
+
+    self.run_quietly(cmd, 'Restoring files', pipe=True)
+
+
+  def exportBackup(self, config, file, **kwargs):
+    """Packs a deduplicated backup into an archive, returns its remote path."""
+    self.setRunLocally(config)
+    manifest_file_name = config['backupFolder'] + '/' + file['file']
+    folder = config['tmpFolder'] + '/' + file['hash']
+    archive = folder + compression.get(config).tarExtension
+
+    store = self.getObjectStore(config)
+    cmd = ' && '.join([
+      'rm -rf {folder} && mkdir -p {folder}',
+      "awk -F'\\t' '$1 == \"D\" {{ print $2 }}' {manifest} | while IFS= read -r dir; do mkdir -p \"{folder}$dir\" || exit 1; done",
+      "awk -F'\\t' '$1 == \"F\"' {manifest} | while IFS=$'\\t' read -r type hash path; do obj=\"{store}/${{hash:0:2}}/$hash\"; ln -f \"$obj\" \"{folder}$path\" 2>/dev/null || cp -p \"$obj\" \"{folder}$path\" || exit 1; done",
+      "awk -F'\\t' '$1 == \"L\"' {manifest} | while IFS=$'\\t' read -r type target path; do ln -sfn \"$target\" \"{folder}$path\" || exit 1; done",
+      "#!tar -C {folder} --hard-dereference --transform 's,^\\./,/,' -cPf - . | {compress} > {archive}",
+      'rm -rf {folder}'
+    ]).format(store=store, manifest=manifest_file_name, folder=folder, archive=archive, compress=compression.get(config).compress())
+
+    self.run_quietly(cmd, 'Packing files of %s' % file['hash'], pipe=True)
+    return archive
 
 
   def backupFiles(self, config, **kwargs):
     self.setRunLocally(config)
     filename = kwargs['backup_file_name']
     source_folders = kwargs['sourceFolders'] if 'sourceFolders' in kwargs else []
-
-    if 'filesFolder' in config:
-      source_folders.append(config['filesFolder'])
-    if 'privateFilesFolder' in config:
-      source_folders.append(config['privateFilesFolder'])
+    source_folders += self.getSourceFolders(config)
 
     if len(source_folders) > 0:
       self.tarFiles(config, filename, source_folders, 'backup')
@@ -71,9 +240,11 @@ class FilesMethod(BaseMethod):
 
 
   def listBackups(self, config, results, **kwargs):
-    files = self.list_remote_files(config['backupFolder'], ['*.tgz'])
+    self.setRunLocally(config)
+    extensions = compression.get_tar_extensions() + [ self.manifest_extension, self.snapshot_extension ]
+    files = self.list_remote_files(config['backupFolder'], [ '*' + e for e in extensions ])
     for file in files:
-      hash = re.sub('\.tgz$', '', file)
+      hash = compression.strip_extension(file, extensions)
       backup_result = self.get_backup_result(config, file, hash, 'files')
       if backup_result:
         results.append(backup_result)
@@ -97,8 +268,18 @@ class FilesMethod(BaseMethod):
     tar_file = config['backupFolder'] + '/' + file['file']
     self.run_quietly('mkdir -p ' + config['filesFolder'])
     self.run_quietly('chmod -R 777 ' + config['filesFolder'])
+    if tar_file.endswith(self.manifest_extension):
+      self.restoreFilesDedup(config, tar_file)
+      log.info('files restored from ' + file['file'])
+      return
+
+    if tar_file.endswith(self.snapshot_extension):
+      self.restoreFilesSnapshot(config, tar_file)
+      log.info('files restored from ' + file['file'])
+      return
+
     with cd(config['filesFolder']):
-      self.run_quietly('#!tar -xzPf ' + tar_file, 'Unpacking files')
+      self.run_quietly(compression.for_file(config, tar_file).decompress() + ' < ' + tar_file + ' | #!tar -xPf -', 'Unpacking files', pipe=True)
 
     log.info('files restored from ' + file['file'])
 
@@ -111,24 +292,128 @@ class FilesMethod(BaseMethod):
 
 
     with cd(env.config['rootFolder']):
-      exclude_settings = configuration.getSettings('excludeFiles')
-      exclude_files_setting = exclude_settings['copyFrom']
-      rsync_args = ''
-      if exclude_files_setting:
-        rsync_args = ' --exclude "' + '" --exclude "'.join(exclude_files_setting) + '"'
-
-
-      rsync = '#!rsync -rav --no-o --no-g  -e "ssh -T -o Compression=no {ssh_args} -p {port}" {rsync_args} {user}@{host}:{source_dir}/* {target_dir}'.format(
-        ssh_args=utils.ssh_no_strict_key_host_checking_params,
+      rsync = '#!rsync -rav --no-o --no-g  -e "{ssh}" {rsync_args} {user}@{host}:{source_dir}/* {target_dir}'.format(
+        ssh=self.getRsyncShell(source_config),
         source_dir=source_config[folder],
         target_dir=target_config[folder],
-        rsync_args=rsync_args,
+        rsync_args=self.getRsyncExcludes(),
         **source_config
       )
 
       with warn_only():
         self.run(rsync)
 
+  def getRsyncShell(self, source_config):
+    return 'ssh -T -o Compression=no {ssh_args} -p {port}'.format(
+      ssh_args=utils.ssh_no_strict_key_host_checking_params + utils.get_ssh_multiplexing_params(source_config['user'], source_config['host'], source_config['port'], not self.run_locally),
+      port=source_config['port'])
+
+  def getRsyncExcludes(self):
+    exclude_settings = configuration.getSettings('excludeFiles')
+    exclude_files_setting = exclude_settings['copyFrom'] if exclude_settings and 'copyFrom' in exclude_settings else False
+    if exclude_files_setting:
+      return ' --exclude "' + '" --exclude "'.join(exclude_files_setting) + '"'
+    return ''
+
+  def runOnSource(self, source_config, cmd):
+    source_host_string = join_host_strings(source_config['user'], source_config['host'], source_config['port'])
+    with _settings(host_string=source_host_string), self.runLocally(source_config), hide('running', 'output', 'warnings'), warn_only():
+      return self.run(cmd, capture=True)
+
+  def listSourceEntries(self, source_config, folder):
+    result = self.runOnSource(source_config, 'ls -A1 ' + pipes.quote(folder))
+    return result.stdout.splitlines() if result.return_code == 0 else []
+
+  def getFilesManifest(self, result, include_hidden):
+    """Parses the output of find -printf into a dict of path => (size, mtime)."""
+    if result.return_code != 0:
+      return False
+
+    exclude_settings = configuration.getSettings('excludeFiles')
+    excludes = exclude_settings['copyFrom'] if exclude_settings and 'copyFrom' in exclude_settings else []
+    manifest = {}
+    for line in result.stdout.splitlines():
+      tokens = line.rsplit('\t', 2)
+      if len(tokens) != 3:
+        continue
+      path, size, mtime = tokens
+      parts = path.split('/')
+      # rsync copies folder/*, which skips hidden top-level entries.
+      if not include_hidden and parts[0].startswith('.'):
+        continue
+      if any(fnmatch.fnmatch(part, pattern) for part in parts for pattern in excludes):
+        continue
+      manifest[path] = (int(size), int(float(mtime)))
+    return manifest
+
+  def getChangedFiles(self, source_config, target_config, folder, include_hidden = False):
+    """Compares path, size and mtime of all files of folder on source and
+    target, returns the number of files and bytes rsync would transfer or
+    False, if the manifests could not be created."""
+    cmd = '#!find {folder} -type f -printf "%P\\t%s\\t%T@\\n"'
+    source = self.getFilesManifest(self.runOnSource(source_config, cmd.format(folder=pipes.quote(source_config[folder]))), include_hidden)
+    self.setRunLocally(target_config)
+    with hide('running', 'output', 'warnings'), warn_only():
+      target = self.getFilesManifest(self.run(cmd.format(folder=pipes.quote(target_config[folder])), capture=True), include_hidden)
+
+    if source is False or target is False:
+      return False
+
+    changed = [ path for path, stat in source.iteritems() if target.get(path) != stat ]
+    return (len(changed), sum(source[path][0] for path in changed))
+
+  def rsyncSharded(self, source_config, target_config, folders, workers):
+    """Copies the folders with up to workers concurrent rsyncs.
+
+    The top-level entries of all folders get distributed over the shards,
+    every shard runs one rsync per folder, all shards run at the same time.
+    """
+    if not target_config['supportsCopyFrom']:
+      log.error('The configuration "{c} does not support copyFrom'.format(c=source_config['config_name']))
+      return
+
+    shards = [ {} for i in range(workers) ]
+    index = 0
+    for folder in folders:
+      for entry in self.listSourceEntries(source_config, source_config[folder]):
+        shards[index % workers].setdefault(folder, []).append(entry)
+        index += 1
+    self.setRunLocally(target_config)
+
+    shards = [ shard for shard in shards if shard ]
+    if not shards:
+      log.info('Nothing to copy from {f}'.format(f=source_config['config_name']))
+      return
+
+    log.info('Copying files from {f} to {t} with {n} rsync-workers'.format(f=source_config['config_name'], t=target_config['config_name'], n=len(shards)))
+
+    log_file = target_config['tmpFolder'] + '/fabalicious-rsync-' + target_config['config_name']
+    cmds = []
+    for i, shard in enumerate(shards):
+      rsyncs = []
+      for folder, entries in sorted(shard.items()):
+        sources = ' '.join(pipes.quote('{user}@{host}:{folder}/{entry}'.format(folder=source_config[folder], entry=entry, **source_config)) for entry in entries)
+        rsyncs.append('#!rsync -ra --protect-args --stats --no-o --no-g -e "{ssh}"{rsync_args} {sources} {target_dir}/'.format(
+          ssh=self.getRsyncShell(source_config),
+          rsync_args=self.getRsyncExcludes(),
+          sources=sources,
+          target_dir=target_config[folder]))
+      cmds.append('( {rsyncs} ) > {log}-{i}.log 2>&1 & pids="$pids $!"'.format(rsyncs=' && '.join(rsyncs), log=log_file, i=i))
+
+    cmd = 'pids=""; ' + '; '.join(cmds) + '; rc=0; for pid in $pids; do wait $pid || rc=1; done; cat {log}-*.log; rm -f {log}-*.log; exit $rc'.format(log=log_file)
+
+    start_time = time.time()
+    with hide('running', 'output'), warn_only():
+      result = self.run_pipe(cmd, capture=True)
+
+    files = sum(int(n.replace(',', '')) for n in re.findall('^Number of (?:regular )?files transferred: ([\d,]+)', result.stdout, re.MULTILINE))
+    size = sum(int(n.replace(',', '')) for n in re.findall('^Total transferred file size: ([\d,]+)', result.stdout, re.MULTILINE))
+    log.info('Copied {files} files ({size:.1f} MB) in {duration:.1f}s'.format(files=files, size=size / 1024.0 / 1024.0, duration=time.time() - start_time))
+
+    if result.return_code != 0:
+      log.error('Copying files from {f} failed:'.format(f=source_config['config_name']))
+      print result.stdout
+
   def put(self, config, filename):
     put(filename, config['tmpFolder'])
 
@@ -142,9 +427,40 @@ class FilesMethod(BaseMethod):
     else:
       log.error("Could not find file '%s' on remote!" % remotePath)
 
-  def copyFilesFrom(self, config, source_config=False, **kwargs):
+  def copyFilesFrom(self, config, source_config=False, dryRun=False, **kwargs):
     self.setRunLocally(config)
-    keys = ['filesFolder', 'privateFilesFolder']
+    keys = [ key for key in ['filesFolder', 'privateFilesFolder'] if key in source_config and key in config ]
+
+    changed_keys = []
+    for key in keys:
+      start_time = time.time()
+      changes = self.getChangedFiles(source_config, config, key, config['rsyncWorkers'] > 1)
+      if changes is False:
+        log.warning('Could not compare {key} of {f} and {t}, copying all files'.format(key=key, f=source_config['config_name'], t=config['config_name']))
+        changed_keys.append(key)
+        continue
+
+      files, size = changes
+      log.info('{key}: {files} files ({size:.1f} MB) to transfer from {f}, compared in {duration:.1f}s'.format(
+        key=key,
+        files=files,
+        size=size / 1024.0 / 1024.0,
+        f=source_config['config_name'],
+        duration=time.time() - start_time))
+      if files > 0:
+        changed_keys.append(key)
+
+    if str(dryRun).lower() in [ 'true', '1', 'yes' ]:
+      return
+
+    keys = changed_keys
+    if not keys:
+      log.info('Nothing changed, skipping rsync')
+      return
+
+    if config['rsyncWorkers'] > 1:
+      self.rsyncSharded(source_config, config, keys, int(config['rsyncWorkers']))
+      return
+
     for key in keys:
-      if key in source_config and key in config:
-        self.rsync(source_config, config, key)
+      self.rsync(source_config, config, key)
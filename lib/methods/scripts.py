@@ -7,6 +7,7 @@ from fabric.contrib.files import exists
 from fabric.network import *
 from fabric.context_managers import settings as _settings
 from lib import configuration
+from lib import timings
 import re, copy
 
 class ScriptMethod(BaseMethod):
@@ -79,21 +80,24 @@ class ScriptMethod(BaseMethod):
               arguments = map(lambda x: x.strip(), arguments)
 
             log.debug('Executing "%s"' % func_name)
-            if arguments:
-              callbacks[func_name](state, *arguments)
-            else:
-              callbacks[func_name](state)
+            with timings.span(line, 'callback'):
+              if arguments:
+                callbacks[func_name](state, *arguments)
+              else:
+                callbacks[func_name](state)
             handled = True
 
         if not handled:
           line = self.expandCommand(line)
           log.debug('Running "%s"' % line)
-          if state['warnOnly']:
-            with warn_only():
+          with timings.span(line, 'command', local=runLocally) as span:
+            if state['warnOnly']:
+              with warn_only():
+                result = local(line) if runLocally else run(line)
+                state['return_code'] = state['return_code'] or result.return_code
+            else:
               result = local(line) if runLocally else run(line)
-              state['return_code'] = state['return_code'] or result.return_code
-          else:
-            result = local(line) if runLocally else run(line)
+            span.setExitCode(result.return_code)
             state['return_code'] = state['return_code'] or result.return_code
 
     env.output_prefix = saved_output_prefix
@@ -7,8 +7,10 @@ from lib.utils import SSHTunnel, RemoteSSHTunnel
 from fabric.network import *
 from lib import configuration
 import copy
-import random
 from lib.utils import validate_dict
+from lib import utils
+from lib import tunnels
+from lib import ports
 
 class SSHMethod(BaseMethod):
   tunnels = {}
@@ -25,7 +27,10 @@ class SSHMethod(BaseMethod):
     return {
       'usePty': True,
       'useShell': True,
-      'disableKnownHosts': False
+      'disableKnownHosts': False,
+      'sshMultiplexing': True,
+      'persistentTunnels': False,
+      'persistentTunnelsIdleTimeout': 1800
     }
 
   @staticmethod
@@ -38,6 +43,7 @@ class SSHMethod(BaseMethod):
     defaults['usePty'] = settings['usePty']
     defaults['useShell'] = settings['useShell']
     defaults['disableKnownHosts'] = settings['disableKnownHosts']
+    defaults['sshMultiplexing'] = settings['sshMultiplexing']
 
   @staticmethod
   def applyConfig(config, settings):
@@ -49,13 +55,17 @@ class SSHMethod(BaseMethod):
       config["sshTunnel"]["destHostFromDockerContainer"] = docker_name
 
     if "sshTunnel" in config:
+      if not 'persistent' in config['sshTunnel']:
+        config['sshTunnel']['persistent'] = settings['persistentTunnels']
+
       if not 'localPort' in config['sshTunnel']:
         if 'port' in config:
           config['sshTunnel']['localPort'] = config['port']
         else:
 
           if config['config_name'] not in SSHMethod.sshPorts:
-            SSHMethod.sshPorts[config['config_name']] = random.randrange(1025, 65535)
+            port = config['sshTunnel']['persistent'] and tunnels.find_port(config['config_name'])
+            SSHMethod.sshPorts[config['config_name']] = port or ports.allocate(config['config_name'])
 
           port = SSHMethod.sshPorts[config['config_name']]
           config['sshTunnel']['localPort'] = port
@@ -125,6 +135,11 @@ class SSHMethod(BaseMethod):
 
     if remote:
       tunnel = RemoteSSHTunnel(source_config, o['bridgeUser'], o['bridgeHost'], o['destHost'], o['bridgePort'], o['destPort'], o['localPort'], strictHostKeyChecking)
+    elif o.get('persistent'):
+      cmd = SSHTunnel.getSSHCommand(o['bridgeUser'], o['bridgeHost'], o['destHost'], o['bridgePort'], o['destPort'], o['localPort'], strictHostKeyChecking)
+      cmd += ' -o ServerAliveInterval=30'
+      tunnel_config = dict((k, o[k]) for k in ['bridgeUser', 'bridgeHost', 'bridgePort', 'destHost', 'destPort', 'localPort'])
+      tunnel = tunnels.get(target_config['config_name'], tunnel_config, cmd, configuration.getSettings('persistentTunnelsIdleTimeout'))
     else:
       tunnel = SSHTunnel(o['bridgeUser'], o['bridgeHost'], o['destHost'], o['bridgePort'], o['destPort'], o['localPort'], strictHostKeyChecking)
 
@@ -178,7 +193,8 @@ class SSHMethod(BaseMethod):
 
 
   def doctor_ssh_connection(self, config):
-    output = local('ssh -A -o StrictHostKeyChecking=no -o PasswordAuthentication=no -o BatchMode=yes -o ConnectTimeout=5 -p {port} {user}@{host} echo ok'.format(**config), capture=True)
+    args = utils.get_ssh_multiplexing_params(config['user'], config['host'], config['port'])
+    output = local('ssh -A -o StrictHostKeyChecking=no -o PasswordAuthentication=no -o BatchMode=yes -o ConnectTimeout=5 {args}-p {port} {user}@{host} echo ok'.format(args=args, **config), capture=True)
     if output.return_code != 0:
       log.error('Cannot connect to host! Please check if the host is running and reachable, and check if your public key is added to authorized_keys on the remote host.')
       log.error('Try: ssh -p {port} {user}@{host}'.format(**config))
@@ -1,5 +1,6 @@
 from os.path import expanduser
 from lib import configuration
+from lib import timings
 import logging
 log = logging.getLogger('fabric.fabalicious.plugins')
 
@@ -40,7 +41,8 @@ def getTasks(root_folder):
     __import__('imp').find_module('yapsy')
     from task import ITaskPlugin
 
-    return loadPlugins(root_folder, 'task', { "Task": ITaskPlugin })
+    with timings.measure('load task plugins'):
+      return loadPlugins(root_folder, 'task', { "Task": ITaskPlugin })
 
   except ImportError:
     log.warning('Custom plugins disabled, as yapsy is not installed!')
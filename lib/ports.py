@@ -0,0 +1,100 @@
+import logging
+log = logging.getLogger('fabric.fabalicious.ports')
+
+import os
+import json
+import time
+import errno
+import fcntl
+import socket
+import hashlib
+from contextlib import contextmanager
+
+port_range = (20000, 40000)
+
+
+def get_lease_filename():
+  folder = os.path.expanduser("~") + "/.fabalicious"
+  if not os.path.exists(folder):
+    os.makedirs(folder)
+  return folder + '/ports.json'
+
+
+@contextmanager
+def locked():
+  """Serializes the allocation across concurrent fab-processes."""
+  with open(get_lease_filename() + '.lock', 'a') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_leases():
+  try:
+    with open(get_lease_filename(), 'r') as stream:
+      return json.load(stream)
+  except (IOError, ValueError):
+    return {}
+
+
+def save_leases(leases):
+  filename = get_lease_filename()
+  with open(filename + '.tmp', 'w') as stream:
+    json.dump(leases, stream)
+  os.rename(filename + '.tmp', filename)
+
+
+def is_running(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True
+
+
+def is_free(port):
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  try:
+    sock.bind(('127.0.0.1', port))
+    return True
+  except socket.error:
+    return False
+  finally:
+    sock.close()
+
+
+def get_candidates(name):
+  # Start at a stable position per name, so names rarely compete for a port.
+  first, last = port_range
+  size = last - first
+  start = int(hashlib.md5(name).hexdigest(), 16) % size
+  for i in xrange(size):
+    yield first + (start + i) % size
+
+
+def allocate(name):
+  """Returns a free local port for name and leases it to this process.
+
+  The port leased to name before is preferred, ports leased to other names
+  by running processes are skipped.
+  """
+  with locked():
+    leases = load_leases()
+    held = set(lease['port'] for key, lease in leases.iteritems() if key != name and is_running(lease['pid']))
+
+    candidates = get_candidates(name)
+    if name in leases:
+      candidates = [ leases[name]['port'] ] + list(candidates)
+
+    for port in candidates:
+      if port not in held and is_free(port):
+        leases[name] = { 'port': port, 'pid': os.getpid(), 'updated': time.time() }
+        save_leases(leases)
+        log.debug('Allocated local port %d for %s' % (port, name))
+        return port
+
+  log.error('Could not find a free local port for %s' % name)
+  exit(1)
@@ -0,0 +1,178 @@
+import logging
+log = logging.getLogger('fabric.fabalicious.timings')
+
+import os
+import time
+import json
+import atexit
+from contextlib import contextmanager
+
+startup = []
+startup_profile = False
+
+
+def record(label, start_time):
+  startup.append((label, time.time() - start_time))
+
+
+@contextmanager
+def measure(label):
+  start_time = time.time()
+  try:
+    yield
+  finally:
+    record(label, start_time)
+
+
+def enableStartupProfile():
+  global startup_profile
+  if not startup_profile:
+    startup_profile = True
+    atexit.register(printStartupProfile)
+
+
+def printStartupProfile():
+  total = sum(duration for label, duration in startup)
+  print "\nStartup profile:"
+  for label, duration in startup:
+    print "  {label:<40}  {duration:8.1f} ms".format(label=label, duration=duration * 1000)
+  print "  {label:<40}  {duration:8.1f} ms".format(label='total', duration=total * 1000)
+
+
+# Tracing of tasks, methods and commands.
+
+tracing = False
+trace_file = False
+spans = []
+stack = []
+
+
+class Span(object):
+  def __init__(self, name, category, parent, args):
+    self.name = name
+    self.category = category
+    self.parent = parent
+    self.depth = parent.depth + 1 if parent else 0
+    self.args = args
+    self.children = []
+    self.start = time.time()
+    self.duration = 0
+
+  def setExitCode(self, exit_code):
+    self.args['exit_code'] = exit_code
+
+
+class NullSpan(object):
+  def setExitCode(self, exit_code):
+    pass
+
+null_span = NullSpan()
+
+
+@contextmanager
+def span(name, category, **args):
+  """Record a nested span, if tracing is enabled.
+
+  Yields an object, which allows to attach the exit code of a command.
+  """
+  if not tracing:
+    yield null_span
+    return
+
+  current = Span(name, category, stack[-1] if stack else None, args)
+  if current.parent:
+    current.parent.children.append(current)
+  else:
+    spans.append(current)
+
+  stack.append(current)
+  try:
+    yield current
+  except BaseException as e:
+    if 'exit_code' not in current.args:
+      current.args['exit_code'] = getattr(e, 'code', None) if isinstance(e, SystemExit) else 'error'
+    raise
+  finally:
+    current.duration = time.time() - current.start
+    stack.pop()
+
+
+def enableTracing(filename = False):
+  global tracing, trace_file
+  if not tracing:
+    atexit.register(printTimings)
+  tracing = True
+  trace_file = filename
+
+
+def summarize(items):
+  """Group sibling spans by category and name, keeping the first order."""
+  groups = []
+  by_key = {}
+  for item in items:
+    key = (item.category, item.name)
+    if key not in by_key:
+      by_key[key] = { 'span': item, 'count': 0, 'duration': 0, 'children': [], 'failed': 0 }
+      groups.append(by_key[key])
+    group = by_key[key]
+    group['count'] += 1
+    group['duration'] += item.duration
+    group['children'] += item.children
+    if item.args.get('exit_code') not in (None, 0):
+      group['failed'] += 1
+  return groups
+
+
+def printSpans(items, indent, total, width = 30):
+  for group in summarize(items):
+    item = group['span']
+    label = indent + item.name
+    if len(label) > 60:
+      label = label[0:57] + '...'
+    bar = '#' * int(round(width * group['duration'] / total)) if total > 0 else ''
+    extra = ' x%d' % group['count'] if group['count'] > 1 else ''
+    if group['failed']:
+      extra += ' (%d failed)' % group['failed']
+    print "  {label:<60}  {duration:10.1f} ms  {bar:<{width}}{extra}".format(
+      label=label, duration=group['duration'] * 1000, bar=bar, width=width, extra=extra)
+    printSpans(group['children'], indent + '  ', total, width)
+
+
+def printTimings():
+  if not spans:
+    return
+  total = sum(item.duration for item in spans)
+  print "\nTimings:"
+  printSpans(spans, '', total)
+  print "  {label:<60}  {duration:10.1f} ms".format(label='total', duration=total * 1000)
+
+  if trace_file:
+    writeChromeTrace(trace_file)
+
+
+def getTraceEvents(items, events, pid, tid):
+  for item in items:
+    args = dict(item.args)
+    events.append({
+      'name': item.name,
+      'cat': item.category,
+      'ph': 'X',
+      'ts': int(item.start * 1000000),
+      'dur': int(item.duration * 1000000),
+      'pid': pid,
+      'tid': tid,
+      'args': args
+    })
+    getTraceEvents(item.children, events, pid, tid)
+  return events
+
+
+def writeChromeTrace(filename):
+  """Write all spans as Chrome trace-events, viewable via chrome://tracing."""
+  events = getTraceEvents(spans, [], os.getpid(), 1)
+  try:
+    with open(filename, 'w') as stream:
+      json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, stream)
+    log.info('Trace written to %s' % filename)
+  except IOError as e:
+    log.error('Could not write trace to %s: %s' % (filename, e))
@@ -0,0 +1,244 @@
+import logging
+log = logging.getLogger('fabric.fabalicious.tunnels')
+
+import os
+import sys
+import json
+import time
+import glob
+import errno
+import signal
+import hashlib
+import subprocess
+import shlex
+
+if __name__ == '__main__':
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib import utils
+from lib import ports
+
+check_interval = 5
+
+
+class PersistentTunnel(object):
+  """A tunnel kept alive by a watcher-process across fab invocations."""
+
+  def __init__(self, state):
+    self.state = state
+    self.local_port = state['localPort']
+
+  def entrance(self):
+    return 'localhost:%d' % self.local_port
+
+
+def get_state_folder():
+  folder = os.path.expanduser("~") + "/.fabalicious/tunnels"
+  if not os.path.exists(folder):
+    os.makedirs(folder)
+  return folder
+
+
+def get_key(config_name, tunnel_config):
+  m = hashlib.md5()
+  m.update(json.dumps([ config_name, tunnel_config ], sort_keys=True))
+  return m.hexdigest()
+
+
+def get_state_filename(key):
+  return get_state_folder() + '/' + key + '.json'
+
+
+def load_state(filename):
+  try:
+    with open(filename, 'r') as stream:
+      return json.load(stream)
+  except (IOError, ValueError):
+    return False
+
+
+def save_state(filename, state):
+  tmp_filename = filename + '.tmp'
+  with open(tmp_filename, 'w') as stream:
+    json.dump(state, stream)
+  os.rename(tmp_filename, filename)
+
+
+def remove_state(filename):
+  try:
+    os.unlink(filename)
+  except OSError:
+    pass
+
+
+def is_running(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True
+
+
+def has_connections(port):
+  """Returns True if a connection to the local port is established, None if
+  this can't be determined."""
+  tcp_files = [ f for f in ('/proc/net/tcp', '/proc/net/tcp6') if os.path.exists(f) ]
+  if tcp_files:
+    for tcp_file in tcp_files:
+      with open(tcp_file, 'r') as stream:
+        for line in stream.readlines()[1:]:
+          tokens = line.split()
+          # 01 is the state of established connections.
+          if tokens[3] == '01' and int(tokens[1].split(':')[1], 16) == port:
+            return True
+    return False
+
+  try:
+    with open(os.devnull, 'w') as devnull:
+      output = subprocess.check_output([ 'netstat', '-an', '-p', 'tcp' ], stderr=devnull)
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  for line in output.splitlines():
+    tokens = line.split()
+    if 'ESTABLISHED' in tokens and len(tokens) > 3 and tokens[3].replace(':', '.').endswith('.%d' % port):
+      return True
+  return False
+
+
+def get_all():
+  """Returns the state of all persistent tunnels, keyed by state-file."""
+  result = {}
+  for filename in sorted(glob.glob(get_state_folder() + '/*.json')):
+    state = load_state(filename)
+    if state:
+      state['alive'] = 'pid' in state and is_running(state['pid'])
+      state['idle'] = time.time() - os.path.getmtime(filename)
+      result[filename] = state
+  return result
+
+
+def find_port(config_name):
+  """Returns the local port of a running persistent tunnel for config_name."""
+  for filename, state in get_all().iteritems():
+    if state['configName'] == config_name and state['alive']:
+      return state['localPort']
+  return False
+
+
+def get(config_name, tunnel_config, cmd, idle_timeout, timeout = 45):
+  """Returns a running persistent tunnel, starts a new one if needed."""
+  # Concurrent fab-processes must not start the same tunnel twice.
+  with ports.locked():
+    return get_or_start(config_name, tunnel_config, cmd, idle_timeout, timeout)
+
+
+def get_or_start(config_name, tunnel_config, cmd, idle_timeout, timeout):
+  key = get_key(config_name, tunnel_config)
+  filename = get_state_filename(key)
+  state = load_state(filename)
+
+  if state and 'pid' in state and is_running(state['pid']):
+    if utils.wait_for_port('127.0.0.1', state['localPort'], 2):
+      # Mark the tunnel as used, the watcher checks the mtime for idleness.
+      os.utime(filename, None)
+      log.debug('Reusing persistent tunnel %s for %s' % (key, config_name))
+      return PersistentTunnel(state)
+
+    close(filename)
+
+  state = {
+    'key': key,
+    'configName': config_name,
+    'localPort': tunnel_config['localPort'],
+    'bridge': '%s@%s:%s' % (tunnel_config['bridgeUser'], tunnel_config['bridgeHost'], tunnel_config['bridgePort']),
+    'dest': '%s:%s' % (tunnel_config['destHost'], tunnel_config['destPort']),
+    'cmd': cmd,
+    'idleTimeout': idle_timeout,
+    'started': time.time()
+  }
+  save_state(filename, state)
+
+  script = os.path.abspath(__file__)
+  if script.endswith('.pyc'):
+    script = script[:-1]
+
+  with open(os.devnull, 'w') as devnull:
+    watcher = subprocess.Popen([ sys.executable, script, 'watch', filename ],
+      stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+
+  start_time = time.time()
+  if not utils.wait_for_port('127.0.0.1', state['localPort'], timeout, watcher):
+    log.error('Could not establish persistent tunnel with command %s' % cmd)
+    close(filename, watcher.pid)
+    return False
+
+  log.debug('Persistent tunnel %s established in %.1f ms' % (key, (time.time() - start_time) * 1000))
+  return PersistentTunnel(load_state(filename) or state)
+
+
+def close(filename, pid = None):
+  """Closes the tunnel of a state-file, if pid is set only if it belongs to
+  the watcher with that pid."""
+  state = load_state(filename)
+  if state and 'pid' in state:
+    if pid and state['pid'] != pid:
+      return
+    pid = state['pid']
+
+  if pid and is_running(pid):
+    try:
+      os.kill(pid, signal.SIGTERM)
+    except OSError:
+      pass
+  remove_state(filename)
+
+
+def watch(filename):
+  """Runs the tunnel of a state-file until it is idle, broken or terminated."""
+  state = load_state(filename)
+  if not state:
+    return
+
+  with open(os.devnull, 'w') as devnull:
+    p = subprocess.Popen(shlex.split(state['cmd']), stdin=devnull, stdout=devnull, stderr=devnull)
+
+  def terminate(*args):
+    if p.poll() == None:
+      p.terminate()
+    current = load_state(filename)
+    if current and current.get('pid') == os.getpid():
+      remove_state(filename)
+    sys.exit(0)
+
+  signal.signal(signal.SIGTERM, terminate)
+  signal.signal(signal.SIGINT, terminate)
+
+  state['pid'] = os.getpid()
+  state['sshPid'] = p.pid
+  save_state(filename, state)
+
+  while True:
+    time.sleep(check_interval)
+
+    # ssh exits on its own if the connection breaks, as the command uses
+    # ServerAliveInterval, so there's no need to connect through the tunnel.
+    if p.poll() != None:
+      terminate()
+
+    try:
+      # A tunnel with open connections is in use, even if no fab-invocation
+      # touched the state-file for a while.
+      if has_connections(state['localPort']):
+        os.utime(filename, None)
+      idle = time.time() - os.path.getmtime(filename)
+    except OSError:
+      # The state-file got removed, so nobody can use the tunnel anymore.
+      terminate()
+
+    if idle > state['idleTimeout']:
+      terminate()
+
+
+if __name__ == '__main__':
+  if len(sys.argv) == 3 and sys.argv[1] == 'watch':
+    watch(sys.argv[2])
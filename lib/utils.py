@@ -3,47 +3,136 @@ log = logging.getLogger('fabalicious.utils')
 
 from fabric.api import *
 import subprocess, shlex, atexit, time
+import tempfile, shutil, pipes
+import socket, select, errno
 import time
 import os
 import sys
 import yaml
 import logging.config
+from lib import timings
 
 ssh_no_strict_key_host_checking_params = '-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null '
 
-class TunnelBase:
+# Use the C-implementation of the yaml-parser if available.
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def load_yaml(stream):
+  return yaml.load(stream, Loader=yaml_loader)
+
+# Share one ssh-connection per user@host:port via OpenSSH's ControlMaster.
+# %C is a hash of the connection, as long hostnames would exceed the maximum
+# length of a socket-path.
+ssh_multiplexing = False
+ssh_control_persist = 60
+ssh_control_folder = False
+ssh_control_masters = set()
+
+def get_ssh_multiplexing_params(user, host, port = 22, remote = False):
+  """Returns the ssh-options to reuse a shared connection to user@host:port.
+
+  Local masters live in a folder per run and are closed on exit, masters
+  created by commands running on a remote host close themselves after
+  ssh_control_persist seconds of inactivity.
+  """
+  global ssh_control_folder
+
+  if not ssh_multiplexing:
+    return ''
+
+  if remote:
+    control_path = '~/.ssh/fabalicious-%C'
+  else:
+    if not ssh_control_folder:
+      ssh_control_folder = tempfile.mkdtemp(prefix='fabalicious-ssh-')
+      atexit.register(close_ssh_control_masters)
+    control_path = ssh_control_folder + '/%C'
+    ssh_control_masters.add((user, host, port))
+
+  return '-o ControlMaster=auto -o ControlPath={path} -o ControlPersist={persist} '.format(path=control_path, persist=ssh_control_persist)
+
+def close_ssh_control_masters():
+  global ssh_control_folder
+
+  if not ssh_control_folder:
+    return
+
+  with open(os.devnull, 'w') as devnull:
+    for user, host, port in ssh_control_masters:
+      cmd = ['ssh', '-o', 'ControlPath=' + ssh_control_folder + '/%C', '-O', 'exit', '-p', str(port), '%s@%s' % (user, host)]
+      subprocess.call(cmd, stdout=devnull, stderr=devnull)
+
+  ssh_control_masters.clear()
+  shutil.rmtree(ssh_control_folder, True)
+  ssh_control_folder = False
+
+def wait_for_port(host, port, timeout, process = None):
+  """Wait until host:port accepts connections, using non-blocking connects.
+
+  Returns False if the deadline passed or process terminated before.
+  """
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    if process and process.poll() != None:
+      return False
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    try:
+      result = sock.connect_ex((host, port))
+      if result in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+        remaining = max(0, min(1, deadline - time.time()))
+        readable, writable, failed = select.select([], [sock], [], remaining)
+        result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) if writable else errno.ETIMEDOUT
+      if result == 0:
+        return True
+    finally:
+      sock.close()
+
+    time.sleep(0.05)
+
+  return False
+
+
+open_tunnels = []
 
-  def waitForInteractiveSessions(self, timeout, waitForSendingCommand):
-    start_time = time.time()
-    connectionEstablished = False
-    commandSent = not waitForSendingCommand
-    terminated = False
-    output = ''
-    while not connectionEstablished and not terminated:
-      line = self.p.stderr.readline()
-      output += line
+def close_tunnels():
+  """Terminates all tunnels started by the current process.
 
-      self.p.poll()
-      if self.p.returncode != None:
-        terminated = True
+  Needed for processes exiting without running the atexit-handlers, e.g.
+  multiprocessing-workers.
+  """
+  for tunnel in list(open_tunnels):
+    if tunnel.pid == os.getpid():
+      tunnel.terminate()
 
-      if "Sending command" in line:
-        commandSent = True
 
-      if commandSent and 'Entering interactive session' in line:
-        connectionEstablished = True
+class TunnelBase:
 
-      if time.time() > start_time + timeout:
-        terminated = True
+  def start(self, cmd):
+    self.cmd = cmd
+    self.output = tempfile.TemporaryFile()
+    self.start_time = time.time()
+    self.pid = os.getpid()
+    self.p = subprocess.Popen(shlex.split(cmd), stdout=self.output, stderr=self.output)
+    open_tunnels.append(self)
+    atexit.register(self.terminate)
 
-    if not connectionEstablished:
+  def waitUntilReady(self, ready):
+    if not ready:
       log.error("Could not establish tunnel with command %s" % self.cmd)
-      print output
+      self.output.seek(0)
+      print self.output.read()
       exit(1)
 
+    log.debug('Tunnel %s established in %.1f ms' % (self.entrance(), (time.time() - self.start_time) * 1000))
+
   def terminate(self):
-    if self.p.returncode == None:
+    if self.p.poll() == None:
       self.p.kill()
+      self.p.wait()
+    if self in open_tunnels:
+      open_tunnels.remove(self)
 
 
 class SSHTunnel(TunnelBase):
@@ -64,17 +153,21 @@ class SSHTunnel(TunnelBase):
     else:
       cmd = 'ssh'
 
-    cmd = cmd + ' -q -o PasswordAuthentication=no -vAN -L {local_port}:{dest_host}:{dest_port} -p {bridge_port} {bridge_user}@{bridge_host}'.format(**args)
+    # Tunnels don't share a multiplexed connection: a forwarding added to a
+    # shared master outlives the tunnel-process, so terminating the tunnel
+    # would not close the port, and persistent tunnels rely on ssh exiting
+    # when its connection breaks. ExitOnForwardFailure makes ssh exit if the
+    # local port is taken, otherwise the readiness-check would succeed against
+    # the other process listening on it.
+    cmd = cmd + ' -q -o PasswordAuthentication=no -o ExitOnForwardFailure=yes -vAN -L {local_port}:{dest_host}:{dest_port} -p {bridge_port} {bridge_user}@{bridge_host}'.format(**args)
     return cmd
 
   def __init__(self, bridge_user, bridge_host, dest_host, bridge_port=22, dest_port=22, local_port=2022, strictHostKeyChecking = True, timeout=45):
     self.local_port = local_port
 
-    self.cmd = cmd = self.getSSHCommand(bridge_user, bridge_host, dest_host, bridge_port, dest_port, local_port, strictHostKeyChecking)
-
-    self.p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    atexit.register(self.terminate)
-    self.waitForInteractiveSessions(timeout, False)
+    with timings.span('tunnel to %s:%s via %s' % (dest_host, dest_port, bridge_host), 'tunnel'):
+      self.start(self.getSSHCommand(bridge_user, bridge_host, dest_host, bridge_port, dest_port, local_port, strictHostKeyChecking))
+      self.waitUntilReady(wait_for_port('127.0.0.1', local_port, timeout, self.p))
 
   def entrance(self):
     return 'localhost:%d' % self.local_port
@@ -102,7 +195,8 @@ class RemoteSSHTunnel(TunnelBase):
     else:
       remote_cmd = 'ssh'
       cmd = 'ssh'
-    remote_cmd = remote_cmd + ' -q -o PasswordAuthentication=no -v -L {local_port}:{dest_host}:{dest_port} -p {bridge_port} {bridge_user}@{bridge_host} -A -N -M '
+    # No multiplexing for tunnels, see SSHTunnel.getSSHCommand.
+    remote_cmd = remote_cmd + ' -q -o PasswordAuthentication=no -o ExitOnForwardFailure=yes -v -L {local_port}:{dest_host}:{dest_port} -p {bridge_port} {bridge_user}@{bridge_host} -A -N -M '
 
     with hide('running', 'output', 'warnings'):
       run('rm -f ~/.ssh-tunnel-from-fabric')
@@ -123,14 +217,21 @@ class RemoteSSHTunnel(TunnelBase):
     self.bridge_host = bridge_host
     self.bridge_user = bridge_user
 
-    self.cmd = cmd = self.getSSHCommand(config, bridge_user, bridge_host, dest_host, bridge_port, dest_port, local_port, strictHostKeyChecking)
+    with timings.span('remote tunnel to %s:%s via %s' % (dest_host, dest_port, bridge_host), 'tunnel'):
+      self.start(self.getSSHCommand(config, bridge_user, bridge_host, dest_host, bridge_port, dest_port, local_port, strictHostKeyChecking))
+      self.waitUntilReady(self.waitForRemotePort(local_port, timeout))
 
-    self.p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  def waitForRemotePort(self, port, timeout):
+    # The forwarded port lives on the remote host, so probe it there. /dev/tcp
+    # is a bash-feature, so don't rely on the login-shell or useShell.
+    probe = 'for i in $(seq 1 {tries}); do (exec 3<>/dev/tcp/127.0.0.1/{port}) 2>/dev/null && exit 0; sleep 0.1; done; exit 1'.format(
+      tries=int(timeout * 10),
+      port=port)
 
-    atexit.register(self.terminate)
-    self.waitForInteractiveSessions(timeout, True)
+    with hide('running', 'output', 'warnings'), warn_only():
+      result = run('bash -c ' + pipes.quote(probe), shell=False)
 
-    time.sleep(5)
+    return result.return_code == 0 and self.p.poll() == None
 
   def entrance(self):
     return 'localhost:%d' % self.local_port
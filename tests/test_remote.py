@@ -0,0 +1,120 @@
+"""Tests for fetching remote configurations against a local http-server.
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SimpleHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.configuration import remote
+
+
+class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+  """Serves the files of the current folder with an ETag and answers
+  revalidations with 304, which SimpleHTTPServer does not do on its own."""
+
+  def send_head(self):
+    path = self.translate_path(self.path)
+    try:
+      with open(path, 'rb') as stream:
+        etag = '"%s"' % hashlib.md5(stream.read()).hexdigest()
+    except IOError:
+      return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+    self.server.requests.append(self.path)
+    if self.headers.getheader('If-None-Match') == etag:
+      self.server.statuses.append(304)
+      self.send_response(304)
+      self.end_headers()
+      return None
+
+    self.server.statuses.append(200)
+    self.etag = etag
+    return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+  def end_headers(self):
+    if getattr(self, 'etag', None):
+      self.send_header('ETag', self.etag)
+      self.etag = None
+    SimpleHTTPServer.SimpleHTTPRequestHandler.end_headers(self)
+
+  def log_message(self, *args):
+    pass
+
+
+class RemoteFetchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.home = os.environ.get('HOME')
+    os.environ['HOME'] = self.folder + '/home'
+    os.makedirs(self.folder + '/www')
+    self.cwd = os.getcwd()
+    os.chdir(self.folder + '/www')
+
+    self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    self.server.requests = []
+    self.server.statuses = []
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    self.url = 'http://127.0.0.1:%d/fabfile.yaml' % self.server.server_port
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    os.chdir(self.cwd)
+    if self.home is None:
+      del os.environ['HOME']
+    else:
+      os.environ['HOME'] = self.home
+    shutil.rmtree(self.folder)
+
+  def serve(self, content):
+    with open(self.folder + '/www/fabfile.yaml', 'w') as stream:
+      stream.write(content)
+
+  def test_fetch_caches_content(self):
+    self.serve('name: remote\n')
+    self.assertEqual(remote.fetch(self.url), 'name: remote\n')
+    self.assertEqual(self.server.statuses, [ 200 ])
+    self.assertEqual(remote.load_content(self.url), 'name: remote\n')
+    self.assertTrue(remote.load_meta(self.url)['etag'])
+
+  def test_not_modified_keeps_cached_copy(self):
+    self.serve('name: remote\n')
+    remote.fetch(self.url)
+    self.assertEqual(remote.fetch(self.url), 'name: remote\n')
+    self.assertEqual(self.server.statuses, [ 200, 304 ])
+
+  def test_changed_content_invalidates_cache(self):
+    self.serve('name: remote\n')
+    remote.fetch(self.url)
+    self.serve('name: changed\n')
+    self.assertEqual(remote.fetch(self.url), 'name: changed\n')
+    self.assertEqual(self.server.statuses, [ 200, 200 ])
+    self.assertEqual(remote.load_content(self.url), 'name: changed\n')
+
+  def test_ttl_skips_revalidation(self):
+    self.serve('name: remote\n')
+    remote.fetch(self.url, 60)
+    self.assertEqual(remote.fetch(self.url, 60), 'name: remote\n')
+    self.assertEqual(len(self.server.requests), 1)
+
+  def test_fetch_all(self):
+    self.serve('name: remote\n')
+    missing = self.url.replace('fabfile.yaml', 'missing.yaml')
+    results = remote.fetch_all([ self.url, missing ])
+    self.assertEqual(results, { self.url: 'name: remote\n', missing: False })
+
+
+if __name__ == '__main__':
+  unittest.main()